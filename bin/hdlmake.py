@@ -21,70 +21,766 @@ import argparse
 import shutil
 import glob
 import re
-import filecmp
+import itertools
+import subprocess
+from collections import OrderedDict
+import hashlib
+import json
 import urllib2
 import tarfile
-from io import BytesIO
+import tempfile
+import traceback
+import signal
+import select
+import ctypes, ctypes.util
+import time
+import threading
+import contextlib
+import functools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no flock() on Windows, so no job slots shared between processes
 
 topDir = os.path.dirname(os.path.dirname(os.path.realpath(sys.argv[0]))).replace("\\", "/")
 argList = 0
 warnSet = set(["647"])     # The set of xst warnings which should be treated as warnings
 ignoreSet = set(["2036"])  # The set of xst warnings which should be ignored altogether
-branch = "master"
+xrptWarningsRe = re.compile(r'XST_NUMBER_OF_WARNINGS" value="(\d+)"')
+xstMessageRe = re.compile(r"^(?P<severity>WARNING|ERROR):[A-Za-z]+:(?P<code>\d+)\s+-\s+(?P<message>.*?)\s*$")
+xstSourceRe = re.compile(r'"([^"]+)"\s+[Ll]ine\s+(\d+)')
+quartusMessageRe = re.compile(r"^(?P<severity>Error|Warning|Critical Warning)(?: \((?P<code>\d+)\))?: (?P<message>.*?)\s*$")
+quartusSourceRe = re.compile(r" at ([^\s()]+)\((\d+)\)")
+fatalErrorRe = re.compile(r"^(?:ERROR:|FATAL_ERROR:|Error(?: \(\d+\))?:)")  # Xilinx & Quartus errors stop a tool run early
+quartusSummaryRe = re.compile(r"^Info: Quartus II Analysis & Synthesis was successful. (\d+) errors, (\d+) warnings")
+branch = None                # The branch to fetch libraries from; see getBranch()
+cacheDir = os.environ.get("HDLMAKE_CACHE", os.path.expanduser("~/.cache/hdlmake")).replace("\\", "/")
+cacheMaxSize = int(os.environ.get("HDLMAKE_CACHE_SIZE", "2048")) * 1048576  # Size limit of the archive cache
+cacheTtl = int(os.environ.get("HDLMAKE_CACHE_TTL", "3600"))  # How long a cached branch archive is trusted, in seconds
+offline = os.environ.get("HDLMAKE_OFFLINE", "0") == "1"  # Never fetch; fail if a library is not in the archive cache
+cacheLock = threading.Lock()  # Stands in for lockCache()'s flock where there is none (Windows)
+artifactCache = os.environ.get("HDLMAKE_ARTIFACTS")  # Directory or URL of the shared synthesis artifact cache
+githubUrl = os.environ.get("HDLMAKE_GITHUB_URL", "https://github.com")  # Override to fetch from a local mirror
+fetchJobs = 8                # The maximum number of concurrent repo fetches
+buildDbName = ".hdlmake.db"  # The per-directory build database
+historyName = ".hdlmake-history.json"  # The app directory's testbench runtime history, which survives -c
+buildDbs = dict()            # Build databases loaded so far, keyed on absolute directory
+cfgCache = dict()            # Parsed hdlmake.cfg files, keyed on absolute path
+libGraph = dict()            # Resolved libraries, keyed on (directory, variable map)
+depCache = dict()            # Resolved dependencies of app, template & testbench directories
+libStack = []                # Libraries currently being resolved, for cycle detection
+appContext = None            # The app resolved for its testbenches by the top-level run; see setAppContext()
+buildAppDir = None           # The app directory of the build in progress, for designKey()
+hdlIndex = dict()            # Design-unit indexes of HDL files, keyed on content hash & language
+indexVersion = 2             # Bump when the index format changes, to invalidate the on-disk index cache
+patternCache = dict()        # Compiled clean manifests, keyed on pattern list
+cleanPatterns = [            # What -c deletes, unless hdlmake.cfg has a "clean" list
+    "*.bak", "*.bgn", "*.bin", "*.bit", "*.bld", "*.cfi", "*.cmd", "*.cmd_log", "*.csv", "*.csvf",
+    "*.done", "*.dpf", "*.drc", "*.edif", "*.err", "*.gise", "*.gyd", "*.html", "*.ise", "*.jdi", "*.jed",
+    "*.log", "*.lso", "*.map", "*.mcs", "*.mfd", "*.mrp", "*.ncd", "*.ngc", "*.ngd", "*.ngm", "*.ngr",
+    "*.ntrc_log", "*.pad", "*.par", "*.pcf", "*.pin", "*.pnx", "*.pof", "*.prj", "*.prm", "*.ptwx",
+    "*.qpf", "*.qsf", "*.rbf", "*.rpt", "*.sdc", "*.smsg", "*.sof", "*.srf", "*.stx",
+    "*.summary", "*.svf", "*.syr", "*.tspec", "*.twr", "*.twx", "*.txt", "*.unroutes",
+    "*.vm6", "*.xml", "*.xpi", "*.xrpt", "*.xsvf", "*.xwbt",
+    "results.sim", buildDbName,
+    "xst", "db", "incremental_db", "_ngo", "_xmsgs", "auto_project_xdb", "iseconfig", "xlnx_auto_0_xdb",
+    "top_level_html", "simulation", "synthesis", "results", "runs", "build"]
+toolTimeout = None           # Default wall-clock limit of each tool run in seconds (--timeout); None means no limit
+slotBudget = None            # Job slots shared by every hdlmake on the machine (--slots, or $HDLMAKE_SLOTS; default: one per CPU)
+slotPoll = 0.1               # How often a tool waiting for a job slot checks for one, in seconds
+toolThreads = {              # The most threads each multithreaded tool can use (None: no limit), and its argument for one
+    "quartus_map": (None, "1"), "quartus_fit": (None, "1"), "map": (2, "off"), "par": (4, "off")}
+watchSettle = 0.3            # How long watch mode waits for a burst of file changes to settle, in seconds
+watchPoll = 1.0              # How often watch mode polls for file changes when inotify is unavailable, in seconds
+traceFile = None             # Where to write the Chrome trace of the build phases (--trace)
+traceEvents = []             # Completed build phases, as Chrome trace events
+traceLock = threading.Lock()  # Serialises appending to traceEvents from worker threads
+traceLocal = threading.local()  # Per-thread stack of the phases currently running
+traceStart = time.time()     # Time zero of the trace
+ghdlFlags = "--ieee=synopsys --std=93c --vital-checks --warn-binding --warn-reserved --warn-library --warn-vital-generic --warn-delayed-checks --warn-body --warn-specs --warn-unused --warn-error --workdir=simulation --work=work"
 
 # Exception type
 #
 class HDLException(Exception):
     pass
 
-# Fetch the named GitHub repo using HTTP
+# Time the enclosed build phase, recording it in traceEvents as a Chrome trace event with its wall-clock time and the
+# CPU time used by this process and by the child processes it waited for. os.times() is process-wide, so a phase on
+# a worker thread records those as processCpu & processChildCpu, as they include whatever other threads did meanwhile.
+# The args dict is yielded so the phase can record more, e.g. with traceNote()
 #
-def getRepo(user, repo):
-    cwd = os.getcwd()
-    if ( not os.path.exists(user) ):
-        mkdir(user)
-    os.chdir(user)
-    
-    if ( not os.path.exists(repo) ):
-        url = "https://github.com/" + user + "/" + repo + "/archive/" + branch + ".tar.gz"
-        print "Fetching " + url
-        response = urllib2.urlopen(url)
-        tmpFile = BytesIO()
-        while ( True ):
-            chunk = response.read(16384)
-            if ( not chunk ):
-                break;
-            tmpFile.write(chunk)
-        tmpFile.seek(0)
-        tar = tarfile.open(mode="r:gz", fileobj=tmpFile)
-        tar.extractall()
-        tar.close()
-        os.rename(repo + "-" + branch, repo)
-    os.chdir(cwd)
+@contextlib.contextmanager
+def tracePhase(name, category, args = None):
+    args = dict() if ( args == None ) else args
+    stack = traceLocal.__dict__.setdefault("stack", [])
+    stack.append(args)
+    times = os.times()
+    start = time.time()
+    try:
+        yield args
+    except:
+        args["failed"] = True
+        raise
+    finally:
+        end = time.time()
+        endTimes = os.times()
+        stack.pop()
+        cpu = round(endTimes[0] + endTimes[1] - times[0] - times[1], 3)
+        childCpu = round(endTimes[2] + endTimes[3] - times[2] - times[3], 3)
+        if ( threading.current_thread().name == "MainThread" ):
+            args.update(cpu=cpu, childCpu=childCpu)
+        else:
+            args.update(processCpu=cpu, processChildCpu=childCpu)
+        event = {
+            "name": name, "cat": category, "ph": "X",
+            "ts": int((start - traceStart) * 1000000), "dur": int((end - start) * 1000000),
+            "pid": os.getpid(), "tid": threading.current_thread().ident, "args": args}
+        with traceLock:
+            traceEvents.append(event)
+
+# Decorator which traces each call of the function as a build phase in the specified category
+#
+def traced(category):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracePhase(func.__name__, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# Record extra information (cache hit or miss, file counts etc) about the innermost phase running on this thread
+#
+def traceNote(**kwargs):
+    stack = traceLocal.__dict__.get("stack")
+    if ( stack ):
+        stack[-1].update(kwargs)
+
+# Record the peak RSS (in kilobytes) of a child process that just finished against every phase running on this thread,
+# so each phase ends up with the biggest of its own children
+#
+def traceChildRss(rss):
+    for args in traceLocal.__dict__.get("stack", []):
+        if ( rss > args.get("childPeakRssKb", 0) ):
+            args["childPeakRssKb"] = rss
+
+# Write traceEvents to traceFile for chrome://tracing (or Perfetto), and print a per-phase summary of where the time
+# went. Nested phases are included in their parents' totals
+#
+def writeTrace():
+    with open(traceFile, "w") as f:
+        json.dump({"traceEvents": traceEvents, "displayTimeUnit": "ms"}, f)
+    summary = dict()
+    for event in traceEvents:
+        row = summary.setdefault((event["cat"], event["name"]), [0, 0.0, None, None, None, 0])
+        args = event["args"]
+        row[0] += 1
+        row[1] += event["dur"] / 1000000.0
+        if ( "cpu" in args ):
+            row[2] = (row[2] or 0.0) + args["cpu"]
+            row[3] = (row[3] or 0.0) + args["childCpu"]
+        if ( "childPeakRssKb" in args ):
+            row[4] = max(row[4], args["childPeakRssKb"])
+        if ( args.get("cache") == "hit" ):
+            row[5] += 1
+    print "[Timing summary: " + traceFile + "]"
+    print "  {0:<28} {1:>6} {2:>10} {3:>9} {4:>9} {5:>9} {6:>6}".format("Phase", "Count", "Wall(s)", "CPU(s)", "Child(s)", "RSS(MB)", "Hits")
+    for ((category, name), row) in sorted(summary.items(), key=lambda i: -i[1][1]):
+        (cpu, childCpu) = ["-" if ( i == None ) else "{0:.3f}".format(i) for i in row[2:4]]
+        rss = "-" if ( row[4] == None ) else "{0:.1f}".format(row[4] / 1024.0)
+        print "  {0:<28} {1:>6} {2:>10.3f} {3:>9} {4:>9} {5:>9} {6:>6}".format(category + ":" + name, row[0], row[1], cpu, childCpu, rss, row[5])
+
+# Get the branch to fetch libraries from, reading the .branch file only when a library actually needs fetching
+#
+def getBranch():
+    global branch
+    if ( branch == None ):
+        branch = "master"
+        brFileName = topDir + "/.branch"
+        if ( os.path.exists(brFileName) ):
+            brFile = open(brFileName)
+            branch = brFile.read().strip()
+            brFile.close()
+    return branch
+
+# File-like wrapper which computes the SHA-1 of everything read through it
+#
+class HashingReader(object):
+    def __init__(self, f):
+        self.f = f
+        self.sha = hashlib.sha1()
+
+    def read(self, size = -1):
+        data = self.f.read(size)
+        self.sha.update(data)
+        return data
+
+# Get the total size of the files in the specified directory tree
+#
+def treeSize(path):
+    total = 0
+    for (root, dirs, files) in os.walk(path):
+        for i in files:
+            fn = os.path.join(root, i)
+            if ( not os.path.islink(fn) ):
+                total += os.path.getsize(fn)
+    return total
+
+# Write the specified file atomically: the enclosed code writes the yielded temporary file, which then replaces it, so
+# nothing (another thread, or another hdlmake) ever sees the file half-written
+#
+@contextlib.contextmanager
+def atomicWrite(path):
+    tmpName = path + ".tmp" + str(os.getpid()) + "." + str(threading.current_thread().ident)
+    try:
+        yield tmpName
+        if ( os.name == 'nt' and os.path.exists(path) ):
+            os.chmod(path, 0666)  # Windows won't replace a file by renaming, nor delete a read-only one
+            os.remove(path)
+        os.rename(tmpName, path)
+    finally:
+        if ( os.path.exists(tmpName) ):
+            os.remove(tmpName)
+
+# Get the process's umask, which can only be read by setting it
+#
+def getUmask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# Get the regular files in the specified directory tree (none if it doesn't exist)
+#
+def treeFiles(path):
+    found = []
+    for (root, dirs, files) in os.walk(path):
+        found.extend(fn for fn in (os.path.join(root, i) for i in files) if os.path.isfile(fn))
+    return found
+
+# Make the files in the specified tree read-only, so nothing can change them in place through a hardlink
+#
+def makeReadOnly(path):
+    for (root, dirs, files) in os.walk(path):
+        for i in files:
+            fn = os.path.join(root, i)
+            if ( not os.path.islink(fn) ):
+                os.chmod(fn, os.stat(fn).st_mode & ~0222)
+
+# The shutil.rmtree() error handler for trees of read-only files, which Windows refuses to delete
+#
+def removeReadOnly(func, path, excInfo):
+    try:
+        os.chmod(path, 0666)
+        func(path)
+    except OSError:
+        pass
+
+# Hold the lock on the named part of the cache directory for the duration: shared while using its objects, exclusive
+# while evicting them. It's an flock, so it covers every hdlmake sharing the cache as well as this one's threads
+#
+@contextlib.contextmanager
+def lockCache(name, exclusive):
+    if ( fcntl == None ):
+        with cacheLock:
+            yield
+        return
+    mkdir(cacheDir + "/" + name)
+    with open(cacheDir + "/" + name + "/.lock", "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield  # closing the file releases the lock
+
+# Download the specified repo's archive, extracting it as it streams in, into the archive cache's objects directory.
+# The object is keyed on the commit id git-archive records in the tarball, or failing that on the archive's SHA-1.
+# Called by getCachedRepo()
+#
+def downloadRepo(user, repo, objectsDir):
+    url = githubUrl + "/" + user + "/" + repo + "/archive/" + getBranch() + ".tar.gz"
+    sys.stdout.write("Fetching " + url + "\n")
+    mkdir(objectsDir)
+    tmpDir = tempfile.mkdtemp(prefix=".tmp.", dir=objectsDir)
+    try:
+        try:
+            response = urllib2.urlopen(url)
+            reader = HashingReader(response)
+            tar = tarfile.open(mode="r|gz", fileobj=reader)
+            for member in tar:
+                if ( member.name.startswith("/") or ".." in member.name.split("/") ):
+                    raise HDLException("The archive " + url + " contains an unsafe path: " + member.name)
+                if ( (member.issym() or member.islnk()) and (os.path.isabs(member.linkname) or ".." in re.split(r"[/\\]", member.linkname)) ):
+                    # Extracting through it could write outside the archive
+                    raise HDLException("The archive " + url + " contains an unsafe link: " + member.name + " -> " + member.linkname)
+                tar.extract(member, tmpDir)
+            commit = tar.pax_headers.get("comment", "")
+            tar.close()
+            response.close()
+        except (urllib2.URLError, IOError, tarfile.TarError), ex:
+            raise HDLException("Failed to fetch " + url + ": " + str(ex))
+        topLevel = os.listdir(tmpDir)
+        if ( len(topLevel) != 1 ):
+            raise HDLException("The archive " + url + " does not contain exactly one top-level directory")
+        key = commit if re.match(r"^[0-9a-f]{40}$", commit) else "sha1-" + reader.sha.hexdigest()
+        objDir = objectsDir + "/" + key
+        size = treeSize(tmpDir)
+        makeReadOnly(tmpDir)  # workspaces hardlink to it
+        try:
+            os.rename(tmpDir + "/" + topLevel[0], objDir)
+        except OSError:
+            if ( not os.path.isdir(objDir) ):
+                raise
+            # else another fetch of the same archive got there first
+        with open(objDir + ".size", "w") as f:
+            f.write(str(size))
+    finally:
+        shutil.rmtree(tmpDir, False, removeReadOnly)
+    return key
+
+# Evict the least-recently used objects from the archive cache until it fits in cacheMaxSize, always keeping the
+# specified object. Called by getRepo(), holding the cache lock exclusively
+#
+def evictRepos(objectsDir, keep):
+    objects = []
+    total = 0
+    for key in os.listdir(objectsDir):
+        objDir = objectsDir + "/" + key
+        if ( key.startswith(".") or not os.path.isdir(objDir) ):
+            continue
+        try:
+            with open(objDir + ".size") as f:
+                size = int(f.read())
+        except (IOError, ValueError):
+            size = treeSize(objDir)
+        objects.append((os.path.getmtime(objDir), key, size))
+        total += size
+    for (mtime, key, size) in sorted(objects):
+        if ( total <= cacheMaxSize ):
+            break
+        if ( key != keep ):
+            print "Evicting " + key + " from the archive cache"
+            shutil.rmtree(objectsDir + "/" + key, False, removeReadOnly)
+            if ( os.path.exists(objectsDir + "/" + key + ".size") ):
+                os.remove(objectsDir + "/" + key + ".size")
+            total -= size
+
+# Get the directory in the archive cache holding the specified repo's archive for the current branch, downloading
+# it if it's missing or its ref is older than cacheTtl. In offline mode a missing archive is an error. Called by
+# getRepo(), which traces it
+#
+def getCachedRepo(user, repo):
+    reposDir = cacheDir + "/repos"
+    objectsDir = reposDir + "/objects"
+    refDir = reposDir + "/refs/" + user + "/" + repo
+    refFile = refDir + "/" + urllib2.quote(getBranch(), "") + ".json"
+    ref = None
+    if ( os.path.exists(refFile) ):
+        try:
+            with open(refFile) as f:
+                ref = json.load(f)
+        except ValueError:
+            pass
+    if ( ref and os.path.isdir(objectsDir + "/" + ref["key"]) and (offline or time.time() - ref["time"] < cacheTtl) ):
+        key = ref["key"]
+        traceNote(cache="hit")
+    elif ( offline ):
+        raise HDLException("Offline, and " + user + "/" + repo + " (" + getBranch() + ") is not in the archive cache " + reposDir)
+    else:
+        traceNote(cache="miss")
+        key = downloadRepo(user, repo, objectsDir)
+        mkdir(refDir)
+        with atomicWrite(refFile) as tmpName:
+            with open(tmpName, "w") as f:
+                json.dump({"key": key, "time": time.time()}, f)
+    objDir = objectsDir + "/" + key
+    os.utime(objDir, None)  # mark as recently used
+    return objDir
+
+# Populate repoDir from the specified cached directory, hardlinking files where the filesystem allows and copying
+# them otherwise, into a temporary directory which is then renamed into place. The cached files are read-only, so a
+# workspace can't change them for every other workspace
+#
+def populateRepo(srcDir, repoDir):
+    tmpDir = tempfile.mkdtemp(prefix="." + os.path.basename(repoDir) + ".", dir=os.path.dirname(repoDir))
+    canLink = hasattr(os, "link")
+    try:
+        for (root, dirs, files) in os.walk(srcDir):
+            dstRoot = tmpDir + root[len(srcDir):]
+            for i in dirs + files:
+                src = os.path.join(root, i)
+                dst = os.path.join(dstRoot, i)
+                if ( os.path.islink(src) ):
+                    os.symlink(os.readlink(src), dst)
+                elif ( os.path.isdir(src) ):
+                    os.mkdir(dst)
+                else:
+                    mode = os.stat(src).st_mode
+                    if ( mode & 0222 ):
+                        os.chmod(src, mode & ~0222)  # cached before objects were made read-only
+                    if ( canLink ):
+                        try:
+                            os.link(src, dst)
+                            continue
+                        except OSError:
+                            canLink = False  # probably a different filesystem
+                    shutil.copy2(src, dst)
+        os.chmod(tmpDir, 0777 & ~getUmask())  # mkdtemp() made it private
+        try:
+            os.rename(tmpDir, repoDir)
+        except OSError:
+            if ( not os.path.exists(repoDir) ):
+                raise
+            # else another fetch of the same repo got there first
+    finally:
+        shutil.rmtree(tmpDir, False, removeReadOnly)
+
+# Fetch the named GitHub repo into libDir/user/repo, via the local archive cache shared by all workspaces
+#
+@traced("fetch")
+def getRepo(user, repo, libDir = "."):
+    userDir = libDir + "/" + user
+    repoDir = userDir + "/" + repo
+    traceNote(repo=user + "/" + repo)
+    if ( os.path.exists(repoDir) ):
+        traceNote(cache="hit")
+        return
+    mkdir(userDir)
+    with lockCache("repos", False):
+        objDir = getCachedRepo(user, repo)
+        populateRepo(objDir, repoDir)
+    with lockCache("repos", True):
+        evictRepos(os.path.dirname(objDir), os.path.basename(objDir))
+
+# Find every "+/user/repo" library reachable from the hdls list which is not yet in libs/, following local libraries
+# and libraries which have already been fetched. Called by prefetchRepos()
+#
+def findMissingRepos(baseDir, hdls, varMap, missing, seen):
+    for hdl in hdls:
+        if ( hdl[0] == '+' and hdl[1] == '/' ):
+            dirs = varReplace(hdl[2:], varMap).split("/")
+            if ( not os.path.exists(topDir + "/libs/" + dirs[0] + "/" + dirs[1]) ):
+                missing.add((dirs[0], dirs[1]))
+                continue
+            libDir = topDir + "/libs/" + "/".join(dirs)
+        else:
+            libDir = varReplace(hdl if baseDir == None else baseDir + "/" + hdl, varMap)
+        absDir = os.path.abspath(libDir)
+        if ( absDir not in seen and os.path.exists(libDir + "/hdlmake.cfg") ):
+            seen.add(absDir)
+            findMissingRepos(libDir, loadConfig(libDir + "/hdlmake.cfg")["hdls"], varMap, missing, seen)
+
+# Fetch the specified repo, returning an error message rather than raising. Runs in a prefetchRepos() worker thread
+#
+def fetchWorker(userRepo):
+    try:
+        getRepo(userRepo[0], userRepo[1], topDir + "/libs")
+        return None
+    except HDLException, ex:
+        return str(ex)
+    except Exception, ex:
+        return "Failed to fetch " + "/".join(userRepo) + ": " + str(ex)
+
+# Fetch every library needed by the specified directories up-front, several at a time, rather than one at a time as
+# resolution happens to reach them. Each fetched library may need others, so keep going until nothing is missing
+#
+@traced("fetch")
+def prefetchRepos(dirs, varMap):
+    attempted = set()
+    while ( True ):
+        missing = set()
+        seen = set()
+        for baseDir in dirs:
+            tree = readHdlMake(baseDir, False)
+            if ( tree ):
+                findMissingRepos(baseDir, tree["hdls"], varMap, missing, seen)
+        missing -= attempted
+        if ( not missing ):
+            return
+        attempted |= missing
+        pool = ThreadPool(min(fetchJobs, len(missing)))
+        try:
+            errors = [i for i in pool.map(fetchWorker, sorted(missing)) if i]
+        finally:
+            pool.close()
+            pool.join()
+        if ( errors ):
+            raise HDLException("\n  ".join(["Failed to fetch {0} libraries:".format(len(errors))] + errors))
+
+# Find every library reachable from the hdls list which has files missing and a generation rule to make them, adding
+# it to the "needed" map of absolute directory to (directory, parsed hdlmake.cfg). Called by generateLibraries()
+#
+def findGenerations(baseDir, hdls, varMap, needed, seen):
+    for hdl in hdls:
+        if ( hdl[0] == '+' and hdl[1] == '/' ):
+            libDir = varReplace(topDir + "/libs/" + hdl[2:], varMap)
+        else:
+            libDir = varReplace(hdl if baseDir == None else baseDir + "/" + hdl, varMap)
+        absDir = os.path.abspath(libDir)
+        if ( absDir in seen or not os.path.exists(libDir + "/hdlmake.cfg") ):
+            continue
+        seen.add(absDir)
+        tree = loadConfig(libDir + "/hdlmake.cfg")
+        if ( "gen" in tree and (isSomethingMissing(libDir, tree["hdls"]) or isSomethingMissing(libDir, tree.get("ngcs") or [])) ):
+            needed[absDir] = (libDir, tree)
+        findGenerations(libDir, tree["hdls"], varMap, needed, seen)
+
+# Get the generation cache key of a library: the hash of its generation rule, the executable the rule runs, and the
+# library's hdlmake.cfg & *.batch files, from which coregen & qmegawiz generate everything else
+#
+def generationKey(baseDir, tree):
+    h = hashlib.sha1()
+    h.update(tree["gen"] + "\0" + toolDigest(tree["gen"].split()[0]) + "\n")
+    for i in sorted([baseDir + "/hdlmake.cfg"] + glob.glob(baseDir + "/*.batch")):
+        h.update(os.path.basename(i) + "\0" + hashFile(i) + "\n")
+    return h.hexdigest()
+
+# Make a library's missing files by running its generation rule, or by restoring them from the generation cache if
+# the rule has already been run on the same inputs. Called by generateLibraries() and addLibrary()
+#
+@traced("gen")
+def generateLibrary(baseDir, tree):
+    outputs = [i for i in tree["hdls"] + (tree.get("ngcs") or []) if not i.startswith("+/")]
+    key = generationKey(baseDir, tree)
+    archive = cacheDir + "/gen/" + key[:2] + "/" + key + ".tar.gz"
+    traceNote(dir=os.path.abspath(baseDir))
+    if ( os.path.exists(archive) ):
+        try:
+            tar = tarfile.open(archive, "r:gz")
+            for member in tar:
+                if ( not member.isfile() or member.name.startswith("/") or ".." in member.name.split("/") ):
+                    raise HDLException("The generation cache archive " + archive + " contains an unexpected entry: " + member.name)
+                if ( os.path.lexists(baseDir + "/" + member.name) ):
+                    os.remove(baseDir + "/" + member.name)  # replace rather than overwrite, as it may be a cache hardlink
+                tar.extract(member, baseDir)
+            tar.close()
+        except (IOError, OSError, tarfile.TarError), ex:
+            print "Warning: cannot restore " + baseDir + " from the generation cache: " + str(ex)
+        if ( not isSomethingMissing(baseDir, outputs) ):
+            print "Restored the generated files of " + baseDir + " from the generation cache"
+            traceNote(cache="hit")
+            return
+    traceNote(cache="miss")
+    print "Running the generation rule for " + baseDir
+    error = runTool("gen", tree["gen"], None, baseDir)
+    if ( error ):
+        raise HDLException("The generation rule for " + baseDir + " failed: " + error)
+    try:
+        mkdir(os.path.dirname(archive))
+        with atomicWrite(archive) as tmpName:
+            tar = tarfile.open(tmpName, "w:gz")
+            for i in outputs:
+                if ( os.path.isfile(baseDir + "/" + i) ):
+                    tar.add(baseDir + "/" + i, i)
+            tar.close()
+    except (IOError, OSError, tarfile.TarError), ex:
+        print "Warning: cannot store the generated files of " + baseDir + " in the generation cache: " + str(ex)
+
+# Run the generation rule of a library, returning an error message rather than raising. Runs in a generateLibraries()
+# worker thread
+#
+def generateWorker(lib):
+    try:
+        generateLibrary(*lib)
+        return None
+    except HDLException, ex:
+        return str(ex)
+    except Exception, ex:
+        return "The generation rule for " + lib[0] + " failed: " + str(ex)
+
+# Run the generation rules of every library needed by the specified directories which has files missing, up-front and
+# several at a time, rather than one at a time as resolution happens to reach them
+#
+def generateLibraries(dirs, varMap):
+    needed = dict()
+    seen = set()
+    for baseDir in dirs:
+        tree = readHdlMake(baseDir, False)
+        if ( tree ):
+            findGenerations(baseDir, tree["hdls"], varMap, needed, seen)
+    if ( not needed ):
+        return
+    libs = [needed[i] for i in sorted(needed)]
+    pool = ThreadPool(min(len(libs), max(getJobCount(), multiprocessing.cpu_count())))
+    try:
+        errors = [i for i in pool.map(generateWorker, libs) if i]
+    finally:
+        pool.close()
+        pool.join()
+    if ( errors ):
+        raise HDLException("\n  ".join(["{0} generation rules failed:".format(len(errors))] + errors))
 
 # Make the directory if it doesn't exist
 #
 def mkdir(path):
     if ( not os.path.exists(path) ):
-        os.makedirs(path)
+        try:
+            os.makedirs(path)
+        except OSError, ex:
+            if ( ex.errno != errno.EEXIST ):
+                raise
 
-# Find the name of the top-level module in the given HDL file
+# Get the HDL language of the specified file from its extension, or None if it's not an HDL file
 #
-def findTop(hdl):
-    file = ""
-    baseName = os.path.basename(hdl).lower()
+def hdlLanguage(hdl):
+    baseName = hdl.lower()
     if ( baseName.endswith(".v") ):
-        for line in open(hdl):
-            file = file + re.sub(r'^(.*?)(//.*?)?\n', r'\1', line)
-        return re.sub(r'^.*?[mM][oO][dD][uU][lL][eE]\s+(\w+)\s*#?\s*\(.*?$', r'\1', file.replace('\t', ' '))
+        return "verilog"
     elif ( baseName.endswith(".vhdl") or baseName.endswith(".vhd") ):
-        for line in open(hdl):
-            file = file + re.sub(r'^(.*?)(--.*?)?\n', r'\1', line)
-        noTabs = file.replace('\t', ' ')
-        topName = re.sub(r'^.*?[aA][rR][cC][hH][iI][tT][eE][cC][tT][uU][rR][eE]\s+\w+\s+[oO][fF]\s+(\w+)\s*[iI][sS].*?$', r'\1', noTabs)
-        if ( topName == noTabs ):
-            topName = re.sub(r'^.*?[eE][nN][tT][iI][tT][yY]\s+(\w+)\s*[iI][sS].*?$', r'\1', noTabs)
-        return topName
+        return "vhdl"
+    return None
+
+# Split the specified HDL file into tokens, one line at a time, skipping whitespace, comments and the content of
+# strings & character literals. Yields (kind, text) pairs where kind is "id" for identifiers & keywords, "lit" for
+# string & numeric literals, and "op" for everything else
+#
+def hdlTokens(hdl, lang):
+    isVhdl = ( lang == "vhdl" )
+    tokenRe = vhdlTokenRe if isVhdl else verilogTokenRe
+    inBlockComment = False
+    prevKind = None
+    prevText = None
+    for line in open(hdl):
+        pos = 0
+        end = len(line)
+        if ( inBlockComment ):
+            pos = line.find("*/")
+            if ( pos < 0 ):
+                continue
+            pos += 2
+            inBlockComment = False
+        while ( pos < end ):
+            m = tokenRe.match(line, pos)
+            kind = m.lastgroup
+            text = m.group()
+            pos = m.end()
+            if ( kind == "ws" or kind == "comment" ):
+                continue
+            elif ( kind == "block" ):
+                close = line.find("*/", pos)
+                if ( close < 0 ):
+                    inBlockComment = True
+                    break
+                pos = close + 2
+                continue
+            elif ( kind == "op" and text == "'" and isVhdl and prevKind != "id" and prevText != ")" and line[pos+1:pos+2] == "'" ):
+                # A character literal rather than an attribute tick
+                kind = "lit"
+                text = line[pos-1:pos+2]
+                pos += 2
+            prevKind = kind
+            prevText = text
+            yield (kind, text)
+
+vhdlTokenRe = re.compile(r"""
+    (?P<ws>\s+) |
+    (?P<comment>--.*) |
+    (?P<lit>"(?:[^"]|"")*"?|\d[\w.#]*) |
+    (?P<id>[A-Za-z][A-Za-z0-9_]*|\\[^\\]*\\) |
+    (?P<op>.)""", re.VERBOSE | re.DOTALL)
+verilogTokenRe = re.compile(r"""
+    (?P<ws>\s+) |
+    (?P<comment>//.*) |
+    (?P<block>/\*) |
+    (?P<lit>"(?:[^"\\]|\\.)*"?|\d[\w']*|'[sS]?[bBoOdDhH]?\w+|`\w+) |
+    (?P<id>[A-Za-z_][\w$]*|\\\S+) |
+    (?P<op>.)""", re.VERBOSE | re.DOTALL)
+verilogKeywords = set([
+    "always", "and", "assign", "begin", "buf", "case", "casex", "casez", "default", "defparam", "else", "end",
+    "endcase", "endfunction", "endgenerate", "endmodule", "endspecify", "endtask", "for", "forever", "function",
+    "generate", "genvar", "if", "initial", "inout", "input", "integer", "localparam", "macromodule", "module", "nand",
+    "negedge", "nor", "not", "or", "output", "parameter", "posedge", "real", "reg", "repeat", "signed", "specify",
+    "supply0", "supply1", "task", "time", "tri", "unsigned", "while", "wire", "xnor", "xor"])
+
+# Build the design-unit index of the specified HDL file in a single streaming pass. VHDL identifiers are compared
+# case-insensitively but recorded as written. The index lists the design units the file declares (in order), the
+# packages it uses and the units it instantiates. Called by indexHdl()
+#
+def scanHdl(hdl, lang):
+    units = []      # [kind, name, entity] for entity, architecture, package, body, configuration & module
+    uses = []       # [library, unit] from VHDL use clauses
+    instances = []  # [library, unit]; library is "" for component & Verilog module instances
+    isVhdl = ( lang == "vhdl" )
+    k = [None] * 6  # the kinds of the most recent tokens
+    t = [None] * 6  # their text, lower-cased for VHDL
+    o = [None] * 6  # their text as written
+    for (kind, text) in hdlTokens(hdl, lang):
+        k = k[1:] + [kind]
+        t = t[1:] + [text.lower() if isVhdl else text]
+        o = o[1:] + [text]
+        if ( isVhdl ):
+            if ( t[-1] == "is" ):
+                if ( t[-3] == "entity" and k[-2] == "id" ):
+                    units.append(["entity", o[-2], None])
+                elif ( t[-5] == "architecture" and t[-3] == "of" and k[-4] == "id" and k[-2] == "id" ):
+                    units.append(["architecture", o[-4], o[-2]])
+                elif ( t[-4] == "package" and t[-3] == "body" and k[-2] == "id" ):
+                    units.append(["body", o[-2], o[-2]])
+                elif ( t[-3] == "package" and t[-2] != "body" and k[-2] == "id" ):
+                    units.append(["package", o[-2], None])
+                elif ( t[-5] == "configuration" and t[-3] == "of" and k[-4] == "id" and k[-2] == "id" ):
+                    units.append(["configuration", o[-4], o[-2]])
+            elif ( t[-2] == "." and k[-1] == "id" and k[-3] == "id" ):
+                if ( t[-4] == "use" ):
+                    uses.append([t[-3], t[-1]])
+                elif ( t[-4] in ("entity", "configuration") and t[-5] in (":", "use") ):
+                    # A direct instance, or a configuration specification's binding
+                    instances.append([t[-3], t[-1]])
+            elif ( t[-1] == "map" and t[-2] in ("port", "generic") and t[-4] == ":" and k[-3] == "id" ):
+                instances.append(["", t[-3]])
+            elif ( t[-2] == "component" and t[-3] == ":" and k[-1] == "id" ):
+                instances.append(["", t[-1]])
+        else:
+            if ( t[-2] in ("module", "macromodule") and k[-1] == "id" ):
+                units.append(["module", o[-1], None])
+            elif ( t[-1] == "#" and k[-2] == "id" and t[-2] not in verilogKeywords ):
+                if ( t[-3] in (";", "begin", "end", "endgenerate", "generate", "else", ")") ):
+                    instances.append(["", t[-2]])
+            elif ( t[-1] == "(" and k[-2] == "id" and k[-3] == "id" and t[-2] not in verilogKeywords and t[-3] not in verilogKeywords ):
+                instances.append(["", t[-3]])
+    return {"lang": lang, "units": units, "uses": uses, "instances": instances}
+
+# Get the design-unit index of the specified HDL file (see scanHdl()), from the in-memory cache, the on-disk cache
+# keyed on the file's content hash, or by scanning it
+#
+def indexHdl(hdl):
+    lang = hdlLanguage(hdl)
+    if ( lang == None ):
+        return None
+    key = hashFile(hdl) + "." + lang
+    if ( key not in hdlIndex ):
+        indexFile = cacheDir + "/index" + str(indexVersion) + "/" + key[:2] + "/" + key + ".json"
+        index = None
+        if ( os.path.exists(indexFile) ):
+            try:
+                with open(indexFile) as f:
+                    index = json.load(f)
+            except (IOError, ValueError):
+                pass
+        if ( index == None ):
+            index = scanHdl(hdl, lang)
+            try:
+                mkdir(os.path.dirname(indexFile))
+                with atomicWrite(indexFile) as tmpName:
+                    with open(tmpName, "w") as f:
+                        json.dump(index, f)
+            except (IOError, OSError):
+                pass  # the cache is just an optimisation
+        hdlIndex[key] = index
+    return hdlIndex[key]
+
+# Find the name of the top-level module in the given HDL file
+#
+def findTop(hdl):
+    index = indexHdl(hdl)
+    if ( index == None ):
+        return None
+    units = index["units"]
+    if ( index["lang"] == "verilog" ):
+        names = [i[1] for i in units if i[0] == "module"]
+    else:
+        names = [i[2] for i in units if i[0] == "architecture"] or [i[1] for i in units if i[0] == "entity"]
+    if ( not names ):
+        raise HDLException("Cannot find a top-level design unit in " + hdl)
+    return names[0]
 
 # Find out if one or more of the specified files is missing from the specified directory
 #
@@ -101,41 +797,70 @@ def varReplace(path, varMap):
         path = path.replace("${" + key + "}", varMap[key])
     return path
 
-# Called by addHdl()
-#
-def addLibrary(hdlSet, baseDir, varMap):
-    tree = yaml.load(file(baseDir + "/hdlmake.cfg"), yaml.BaseLoader)
-    hdls = tree["hdls"]
-    ngcs = [] if "ngcs" not in tree else tree["ngcs"]
-    if ( isSomethingMissing(baseDir, hdls) or isSomethingMissing(baseDir, ngcs) ):
-        print "Something missing - running the generation rule"
-        if ( "gen" in tree ):
-            cwd = os.getcwd()
-            os.chdir(baseDir)
-            if ( os.system(tree["gen"]) ):
-                raise HDLException("The generation rule for " + baseDir + " failed")
-            os.chdir(cwd)
-        else:
-            raise HDLException("A required file is missing from " + baseDir + " and no generation rule was specified")
-    for hdl in hdls:
-        addHdl(hdlSet, baseDir, hdl, varMap)
-    for ngc in ngcs:
-        shutil.copyfile(baseDir + "/" + ngc, ngc)
+# Read the specified hdlmake.cfg file, parsing it only the first time it's asked for
+#
+def loadConfig(cfgFile):
+    key = os.path.abspath(cfgFile)
+    if ( key not in cfgCache ):
+        cfgCache[key] = yaml.load(file(cfgFile, "r"), yaml.BaseLoader)
+    return cfgCache[key]
+
+# Get a hashable key for the specified variable map
+#
+def varKey(varMap):
+    return tuple(sorted(varMap.items()))
+
+# Make an empty dependency graph node for the specified directory
+#
+def newNode(baseDir):
+    return {"dir": baseDir, "hdls": set(), "own": [], "ngcs": [], "deps": []}
 
-# Called by getDependencies() and addLibrary()
+# Resolve the library in baseDir and everything it depends on, returning its graph node. Each library is resolved only
+# once per variable map; a library which (directly or indirectly) includes itself is an error. Called by addHdl()
 #
-def addHdl(hdlSet, baseDir, hdl, varMap):
+@traced("resolve")
+def addLibrary(baseDir, varMap):
+    absDir = os.path.abspath(baseDir)
+    key = (absDir if os.path.isabs(baseDir) else (os.getcwd(), baseDir), varKey(varMap))
+    traceNote(dir=absDir)
+    if ( key in libGraph ):
+        traceNote(cache="hit")
+        return libGraph[key]
+    if ( absDir in libStack ):
+        cycle = libStack[libStack.index(absDir):] + [absDir]
+        raise HDLException("Library include cycle: " + " -> ".join(cycle))
+    libStack.append(absDir)
+    try:
+        tree = loadConfig(baseDir + "/hdlmake.cfg")
+        hdls = tree["hdls"]
+        ngcs = [] if "ngcs" not in tree else tree["ngcs"]
+        if ( isSomethingMissing(baseDir, hdls) or isSomethingMissing(baseDir, ngcs) ):
+            print "Something missing - running the generation rule"
+            if ( "gen" in tree ):
+                generateLibrary(baseDir, tree)
+            else:
+                raise HDLException("A required file is missing from " + baseDir + " and no generation rule was specified")
+        node = newNode(absDir)
+        for hdl in hdls:
+            addHdl(node, baseDir, hdl, varMap)
+        for ngc in ngcs:
+            node["ngcs"].append((baseDir + "/" + ngc, ngc))
+    finally:
+        libStack.pop()
+    libGraph[key] = node
+    return node
+
+# Add the specified HDL file (or library) to the graph node. Called by getDependencies() and addLibrary()
+#
+def addHdl(node, baseDir, hdl, varMap):
     if ( hdl[0] == '+' and hdl[1] == '/' ):
         # This is a top-level library import
         baseDir = topDir + "/libs/" + hdl[2:]
         baseDir = varReplace(baseDir, varMap)
         if ( not os.path.exists(baseDir) ):
-            cwd = os.getcwd()
-            os.chdir(topDir + "/libs")
-            dirs = hdl[2:].split("/")
-            getRepo(dirs[0], dirs[1])
-            os.chdir(cwd)
-        addLibrary(hdlSet, baseDir, varMap)
+            dirs = varReplace(hdl[2:], varMap).split("/")
+            getRepo(dirs[0], dirs[1], topDir + "/libs")
+        addDependency(node, addLibrary(baseDir, varMap))
     else:
         # It's a relative path; make it absolute
         if ( baseDir != None ):
@@ -143,10 +868,29 @@ def addHdl(hdlSet, baseDir, hdl, varMap):
         hdl = varReplace(hdl, varMap)
         if ( os.path.isdir(hdl) ):
             # This is a library import
-            addLibrary(hdlSet, hdl, varMap)
+            addDependency(node, addLibrary(hdl, varMap))
         else:
             # This is just an HDL file
-            hdlSet.add(hdl)
+            node["own"].append(hdl)
+            node["hdls"].add(hdl)
+
+# Make the node depend on the library, inheriting its HDLs and netlists
+#
+def addDependency(node, lib):
+    if ( lib["dir"] not in node["deps"] ):
+        node["deps"].append(lib["dir"])
+    node["hdls"].update(lib["hdls"])
+    for ngc in lib["ngcs"]:
+        if ( ngc not in node["ngcs"] ):
+            node["ngcs"].append(ngc)
+
+# Get the resolved library graph, mapping each library directory to the library directories it directly depends on
+#
+def getLibraryGraph():
+    graph = dict()
+    for node in libGraph.values():
+        graph.setdefault(node["dir"], set()).update(node["deps"])
+    return graph
 
 # Read the hdlmake.cfg from the specified directory
 #
@@ -154,27 +898,110 @@ def readHdlMake(baseDir, isRequired = True):
     # Construct the real path of the hdlmake.cfg file
     hmFile = "hdlmake.cfg" if baseDir == None else baseDir + "/hdlmake.cfg"
     if ( os.path.exists(hmFile) ):
-        return yaml.load(file(hmFile, "r"), yaml.BaseLoader)
+        return loadConfig(hmFile)
     elif ( isRequired ):
         raise HDLException(hmFile + " not found")
     else:
         return None
 
+# Put the content of the netlist "src" at "dst" by linking it from the netlist store, which keeps one copy of each
+# distinct netlist however many libraries, apps & builds use it, and records which files link to it. Nothing is done
+# if "dst" already has the same content. The stored netlists are read-only, so a tool can't change one in place for
+# every build linked to it. Called by getDependencies() and appBuild()
+#
+def linkNetlist(src, dst):
+    digest = hashFile(src)
+    if ( os.path.exists(dst) and hashFile(dst) == digest ):
+        return
+    objDir = cacheDir + "/netlists/" + digest[:2]
+    obj = objDir + "/" + digest
+    if ( os.path.lexists(dst) ):
+        os.remove(dst)
+    with lockCache("netlists", False):
+        if ( not os.path.exists(obj) ):
+            mkdir(objDir)
+            with atomicWrite(obj) as tmpName:
+                shutil.copyfile(src, tmpName)
+                os.chmod(tmpName, os.stat(tmpName).st_mode & ~0222)
+        try:
+            mode = os.stat(obj).st_mode
+            if ( mode & 0222 ):
+                os.chmod(obj, mode & ~0222)  # stored before netlists were made read-only
+            os.link(obj, dst)
+        except (OSError, AttributeError):
+            shutil.copyfile(src, dst)  # different filesystem, or the stored netlist has gone: same content either way
+        absDst = os.path.abspath(dst)
+        mkdir(obj + ".refs")
+        with open(obj + ".refs/" + hashlib.sha1(absDst).hexdigest(), "w") as f:
+            f.write(absDst)
+
+# Whether the file at "path" still has the content of the stored netlist "obj" named by its SHA-1: either it's a
+# hardlink to it, or (where it had to be copied) its content hashes the same
+#
+def isNetlistRef(path, obj):
+    if ( not os.path.isfile(path) ):
+        return False
+    if ( hasattr(os.path, "samefile") and os.path.samefile(path, obj) ):
+        return True
+    return os.path.getsize(path) == os.path.getsize(obj) and sha1File(path) == os.path.basename(obj)
+
+# Remove the netlists from the store which are no longer linked from anywhere, holding the store's lock so no build
+# links to one as it goes. This walks the whole machine-wide store, so it's only done on request (-c --prune). Called
+# by doClean()
+#
+def pruneNetlists():
+    storeDir = cacheDir + "/netlists"
+    if ( not os.path.isdir(storeDir) ):
+        return
+    with lockCache("netlists", True):
+        for subdir in os.listdir(storeDir):
+            if ( not os.path.isdir(storeDir + "/" + subdir) ):
+                continue
+            for name in os.listdir(storeDir + "/" + subdir):
+                obj = storeDir + "/" + subdir + "/" + name
+                if ( "." in name or not os.path.isfile(obj) ):
+                    continue
+                refsDir = obj + ".refs"
+                refs = os.listdir(refsDir) if ( os.path.isdir(refsDir) ) else []
+                live = 0
+                for ref in refs:
+                    with open(refsDir + "/" + ref) as f:
+                        path = f.read()
+                    if ( isNetlistRef(path, obj) ):
+                        live += 1
+                    else:
+                        os.remove(refsDir + "/" + ref)
+                if ( not live ):
+                    os.chmod(obj, 0666)  # Windows won't delete a read-only file
+                    os.remove(obj)
+                    shutil.rmtree(refsDir, True)
+
 # Called by appBuild(), doValidate() and topBuild()
 #
 def getDependencies(tree, baseDir, varMap):
-    # Get the application's own HDLs
-    dirHdls = tree["hdls"]
+    key = (os.getcwd(), baseDir, varKey(varMap))
+    if ( key not in depCache ):
+        # Get the application's own HDLs
+        dirHdls = tree["hdls"]
 
-    # Get the deduplicated list of HDL files, recursively including library HDLs
-    allHdls = set()
-    for hdl in dirHdls:
-        addHdl(allHdls, baseDir, hdl, varMap)
-    return (dirHdls[0], sorted(allHdls))
+        # Get the deduplicated list of HDL files, recursively including library HDLs
+        node = newNode(os.path.abspath(baseDir if baseDir != None else "."))
+        for hdl in dirHdls:
+            addHdl(node, baseDir, hdl, varMap)
+        for (src, dst) in node["ngcs"]:
+            linkNetlist(src, dst)
+        depCache[key] = (dirHdls[0], sorted(node["hdls"]), node)
+    (topHdl, hdls, node) = depCache[key]
+    return (topHdl, list(hdls))
 
-# Build the current directory - called by topBuild()
+# Build the current directory, or if workDir is given build the current directory's app in that directory - called by
+# topBuild() and runMatrix()
 #
-def appBuild(template, board):
+@traced("build")
+def appBuild(template, board, workDir = None):
+    global buildAppDir
+    buildAppDir = os.getcwd()
+
     # Load the app hdlmake.cfg & template hdlmake.cfg
     varMap = {"board": board}
     appTree = readHdlMake(None)
@@ -200,73 +1027,83 @@ def appBuild(template, board):
 
     # If all we need is a local copy for doing an IDE build, we can exit early
     if ( argList.i ):
-        subdir = argList.i[0]
-        mkdir(subdir)
-        for i in uniqueHdls:
-            shutil.copy(i, subdir)
+        files = list(uniqueHdls)
         if ( vendor == "xilinx" ):  # TODO: what about Altera?
-            ngcList = glob.glob("*.ngc")
-            for i in ngcList:
-                shutil.copy(i, subdir)
-            shutil.copy(boardDir + "/board.ucf", subdir)
+            files.extend(glob.glob("*.ngc"))
+            files.append(boardDir + "/board.ucf")
+        syncExport(argList.i[0], files)
         return
 
-    # Proceed with the build
-    if ( vendor == "xilinx" ):
-        # Create list of HDLs
-        f = open("top_level.prj", "w")
-        for i in uniqueHdls:
-            if ( i.endswith(".vhdl") or i.endswith(".vhd") ):
-                f.write("vhdl work \"" + i.replace("${board}", board) + "\"\n")
-            elif ( i.endswith(".v") ):
-                f.write("verilog work \"" + i.replace("${board}", board) + "\"\n")
-        f.close()
+    # Proceed with the build, in the work directory if there is one
+    if ( workDir == None ):
+        vendorBuild(vendor, boardDir, boardTree, uniqueHdls, board)
+        return
+    appDir = os.getcwd()
+    up = os.path.relpath(appDir, os.path.abspath(workDir)).replace("\\", "/") + "/"
+    mkdir(workDir)
+    for i in glob.glob("*.ngc"):
+        if ( i != "top_level.ngc" ):
+            linkNetlist(i, workDir + "/" + i)
+    os.chdir(workDir)
+    try:
+        vendorBuild(
+            vendor, boardDir if os.path.isabs(boardDir) else up + boardDir, boardTree,
+            [i if os.path.isabs(i) else up + i for i in uniqueHdls], board)
+    finally:
+        os.chdir(appDir)
 
-        # Synthesis
-        mkdir("xst/projnav.tmp")
-
-        # Deal with command-line generics
-        shutil.copyfile(boardDir + "/board.xst", "xst/board.xst")
-        if ( argList.s ):
-            with open("xst/board.xst", "a") as xstFile:
-                xstFile.write("-generics {")
-                xstFile.write(" ".join(argList.s))
-                xstFile.write("}\n")
-        if ( os.system("xst -intstyle ise -ifn xst/board.xst -ofn top_level.syr") ):
-            raise HDLException("The xst process failed")
-
-        # Get Xilinx-specific settings from board.cfg
-        if ( "fpga" in boardTree ):
-            fpga = boardTree["fpga"]
-            mapFlags = boardTree["map_flags"]
-            parFlags = boardTree["par_flags"]
-            if ( mapFlags == None ):
-                mapFlags = ""
-            if ( parFlags == None ):
-                parFlags = ""
-
-            # Run the FPGA build steps
-            if ( os.system("ngdbuild -intstyle ise -dd _ngo -nt timestamp -uc " + boardDir + "/board.ucf -p " + fpga + " top_level.ngc top_level.ngd") ):
-                raise HDLException("The ngdbuild process failed")
-            if ( os.system("map -intstyle ise -p " + fpga + " " + mapFlags + " -ir off -pr off -c 100 -w -o top_level_map.ncd top_level.ngd top_level.pcf") ):
-                raise HDLException("The map process failed")
-            if ( os.system("par -w -intstyle ise -ol high " + parFlags + " top_level_map.ncd top_level.ncd top_level.pcf") ):
-                raise HDLException("The par process failed")
-            if ( os.system("bitgen -intstyle ise -f " + boardDir + "/board.ut top_level.ncd") ):
-                raise HDLException("The bitgen process failed")
-        elif ( "cpld_ngd" in boardTree and "cpld_fit" in boardTree ):
-            cpld_ngd = boardTree["cpld_ngd"]
-            cpld_fit = boardTree["cpld_fit"]
-
-            # Run the CPLD build steps
-            if ( os.system("ngdbuild -intstyle ise -dd _ngo -uc " + boardDir + "/board.ucf -p " + cpld_ngd + " top_level.ngc top_level.ngd") ):
-                raise HDLException("The ngdbuild process failed")
-            if ( os.system("cpldfit -intstyle ise -p " + cpld_fit + " -ofmt vhdl -optimize speed -htmlrpt -loc on -slew fast -init low -inputs 54 -pterms 25 -unused float -power std -terminate keeper top_level.ngd") ):
-                raise HDLException("The cpldfit process failed")
-            if ( os.system("hprep6 -s IEEE1149 -n top_level -i top_level") ):
-                raise HDLException("The hprep6 process failed")
-        else:
-            raise HDLException("The " + boardDir + "/board.cfg describes something which is not recognisable as a Xilinx FPGA or CPLD")
+# Make subdir hold a copy of each of the specified files, for an IDE build. It's a sync rather than a copy: files are
+# copied only if their content changed since the last export, and files exported before which are no longer in the
+# design are removed. The manifest records what was exported. They're copies rather than hardlinks so that an IDE
+# editing them in place changes neither the sources nor the library archive cache
+def syncExport(subdir, files):
+    manifestName = subdir + "/.hdlmake-export.json"
+    mkdir(subdir)
+    manifest = dict()
+    if ( os.path.exists(manifestName) ):
+        try:
+            with open(manifestName, "r") as f:
+                manifest = json.load(f)
+        except ValueError:
+            pass
+    exported = dict()
+    for src in files:
+        name = os.path.basename(src)
+        if ( name in exported ):
+            raise HDLException("Cannot export both " + exported[name][0] + " and " + src + " to " + subdir)
+        exported[name] = (src, hashFile(src))
+    (updated, unchanged, removed) = (0, 0, 0)
+    newManifest = dict()
+    for (name, (src, digest)) in sorted(exported.items()):
+        dst = subdir + "/" + name
+        entry = manifest.get(name)
+        if ( entry and entry[0] == digest and os.path.exists(dst) ):
+            st = os.stat(dst)
+            if ( entry[1:] == [st.st_size, st.st_mtime] ):
+                newManifest[name] = entry
+                unchanged += 1
+                continue
+        if ( os.path.lexists(dst) ):
+            os.remove(dst)
+        shutil.copy2(src, dst)
+        os.chmod(dst, os.stat(dst).st_mode | 0200)  # library files are read-only in the cache
+        st = os.stat(dst)
+        newManifest[name] = [digest, st.st_size, st.st_mtime]
+        updated += 1
+    for name in manifest:
+        if ( name not in newManifest and os.path.lexists(subdir + "/" + name) ):
+            os.remove(subdir + "/" + name)
+            removed += 1
+    with atomicWrite(manifestName) as tmpName:
+        with open(tmpName, "w") as f:
+            json.dump(newManifest, f, indent=1, sort_keys=True)
+    saveBuildDb()
+    print "Exported {0} files to {1}: {2} updated, {3} unchanged, {4} removed".format(len(newManifest), subdir, updated, unchanged, removed)
+
+# Run the vendor build and any programming-file rules in the current directory - called by appBuild()
+def vendorBuild(vendor, boardDir, boardTree, uniqueHdls, board):
+    if ( vendor == "xilinx" ):
+        xilinxBuild(boardDir, boardTree, uniqueHdls, board)
 
         if ( argList.p ):
             # Infer XILINX variable from system PATH
@@ -286,67 +1123,605 @@ def appBuild(template, board):
         
                 # Generate iMPACT batch script from board's template file
                 f = open(boardDir + "/" + batch + ".batch", "r")
-                batch = f.read()
+                script = f.read()
                 f.close()
         
-                batch = batch.replace("${XILINX}", xilinx)
+                script = script.replace("${XILINX}", xilinx)
                 f = open("temp.batch", "w")
                 f.write("setPreference -pref KeepSVF:True\n")
-                f.write(batch)
+                f.write(script)
                 f.close()
-                for i in cmdList:
-                    if ( os.system(i) ):
-                        raise HDLException("The impact process failed")
-                if ( os.system("impact -batch temp.batch") ):
-                    raise HDLException("The impact process failed")
+                for (n, i) in enumerate(cmdList, 1):
+                    error = runTool("genrule-{0}-{1}".format(batch, n), i, None)
+                    if ( error ):
+                        raise HDLException("The impact process failed: " + error)
+                error = runTool("impact", ["impact", "-batch", "temp.batch"])
+                if ( error ):
+                    raise HDLException("The impact process failed: " + error)
                 os.remove("temp.batch")
     elif ( vendor == "altera" ):
-        # Copy board.qsf & board.sdc over
-        shutil.copyfile(boardDir + "/board.qsf", "top_level.qsf")
-        shutil.copyfile(boardDir + "/board.sdc", "top_level.sdc")
-        
-        # Append list of HDLs
-        f = open("top_level.qsf", "a")
-        for i in uniqueHdls:
-            if ( i.endswith(".vhdl") or i.endswith(".vhd") ):
-                f.write("set_global_assignment -name VHDL_FILE " + i + "\n")
-            elif ( i.endswith(".v") ):
-                f.write("set_global_assignment -name VERILOG_FILE " + i + "\n")
-        f.close()
-        
-        # Create top_level.srf file declaring which warnings to ignore
-        f = open("top_level.srf", "w")
-        f.write('{ "Warning" "WCPT_FEATURE_DISABLED_POST" "LogicLock " "Warning (292013): Feature LogicLock is only available with a valid subscription license. You can purchase a software subscription to gain full access to this feature." {  } {  } 0 292013 "Feature %1!s! is only available with a valid subscription license. You can purchase a software subscription to gain full access to this feature." 1 0 "" 0 -1}\n')
-        f.close()
-    
-        # Run the build steps
-        if ( os.system("quartus_map --parallel=1 --read_settings_files=on --write_settings_files=off top_level -c top_level") ):
-            raise HDLException("The quartus_map process failed")
-        if ( os.system("quartus_fit --parallel=1 --read_settings_files=on --write_settings_files=off top_level -c top_level") ):
-            raise HDLException("The quartus_fit process failed")
-        if ( os.system("quartus_asm --read_settings_files=on --write_settings_files=off top_level -c top_level") ):
-            raise HDLException("The quartus_asm process failed")
+        alteraBuild(boardDir, uniqueHdls)
+
         if ( argList.p ):
             genRules = boardTree["genrules"] if ( "genrules" in boardTree ) else dict()
             for batch in argList.p:
                 # Get list of prerequisite commands
                 cmdList = genRules[batch] if ( batch in genRules ) else []
-                for i in cmdList:
-                    if ( os.system(i) ):
-                        raise HDLException("The generation rule failed")
-
-# Work out whether a build is needed by comparing datestamps
-def isBuildNeeded(target, hdls):
-    if ( os.path.exists(target) ):
-        synModTime = os.path.getmtime(target)
-        for i in hdls:
-            if ( os.path.getmtime(i) > synModTime ):
-                return True  # something modified; rebuild
-        return False  # nothing more recent than target, no need to build
+                for (n, i) in enumerate(cmdList, 1):
+                    error = runTool("genrule-{0}-{1}".format(batch, n), i, None)
+                    if ( error ):
+                        raise HDLException("The generation rule failed: " + error)
+
+# Run the Xilinx synthesis & implementation stages in the current directory, each of which only runs if its own
+# inputs changed - called by appBuild()
+def xilinxBuild(boardDir, boardTree, uniqueHdls, board):
+    # Create list of HDLs
+    f = open("top_level.prj", "w")
+    for i in uniqueHdls:
+        if ( i.endswith(".vhdl") or i.endswith(".vhd") ):
+            f.write("vhdl work \"" + i.replace("${board}", board) + "\"\n")
+        elif ( i.endswith(".v") ):
+            f.write("verilog work \"" + i.replace("${board}", board) + "\"\n")
+    f.close()
+
+    # Synthesis
+    mkdir("xst/projnav.tmp")
+
+    # Deal with command-line generics
+    shutil.copyfile(boardDir + "/board.xst", "xst/board.xst")
+    if ( argList.s ):
+        with open("xst/board.xst", "a") as xstFile:
+            xstFile.write("-generics {")
+            xstFile.write(" ".join(argList.s))
+            xstFile.write("}\n")
+    netlists = [i for i in glob.glob("*.ngc") if i != "top_level.ngc"]
+    stages = [(
+        "xst", ["xst", "-intstyle", "ise", "-ifn", "xst/board.xst", "-ofn", "top_level.syr"],
+        uniqueHdls + ["top_level.prj", "xst/board.xst"], ["top_level.ngc"])]
+
+    # Get Xilinx-specific settings from board.cfg
+    ucf = boardDir + "/board.ucf"
+    if ( "fpga" in boardTree ):
+        fpga = boardTree["fpga"]
+        mapFlags = boardTree["map_flags"]
+        parFlags = boardTree["par_flags"]
+        if ( mapFlags == None ):
+            mapFlags = ""
+        if ( parFlags == None ):
+            parFlags = ""
+        if ( isEnabled(boardTree, "multithreading") ):
+            # The FPGA family supports multithreaded map & par, so they may use more than one job slot
+            mapFlags += " -mt {threads}"
+            parFlags += " -mt {threads}"
+
+        # The FPGA build stages
+        stages.append((
+            "ngdbuild", ["ngdbuild", "-intstyle", "ise", "-dd", "_ngo", "-nt", "timestamp", "-uc", ucf, "-p", fpga, "top_level.ngc", "top_level.ngd"],
+            ["top_level.ngc", ucf] + netlists, ["top_level.ngd"]))
+        stages.append((
+            "map", ["map", "-intstyle", "ise", "-p", fpga] + mapFlags.split() + ["-ir", "off", "-pr", "off", "-c", "100", "-w", "-o", "top_level_map.ncd", "top_level.ngd", "top_level.pcf"],
+            ["top_level.ngd"], ["top_level_map.ncd", "top_level.pcf"]))
+        stages.append((
+            "par", ["par", "-w", "-intstyle", "ise", "-ol", "high"] + parFlags.split() + ["top_level_map.ncd", "top_level.ncd", "top_level.pcf"],
+            ["top_level_map.ncd", "top_level.pcf"], ["top_level.ncd"]))
+        stages.append((
+            "bitgen", ["bitgen", "-intstyle", "ise", "-f", boardDir + "/board.ut", "top_level.ncd"],
+            ["top_level.ncd", "top_level.pcf", boardDir + "/board.ut"], ["top_level.bit"]))
+    elif ( "cpld_ngd" in boardTree and "cpld_fit" in boardTree ):
+        cpld_ngd = boardTree["cpld_ngd"]
+        cpld_fit = boardTree["cpld_fit"]
+
+        # The CPLD build stages
+        stages.append((
+            "ngdbuild", ["ngdbuild", "-intstyle", "ise", "-dd", "_ngo", "-uc", ucf, "-p", cpld_ngd, "top_level.ngc", "top_level.ngd"],
+            ["top_level.ngc", ucf] + netlists, ["top_level.ngd"]))
+        stages.append((
+            "cpldfit", ["cpldfit", "-intstyle", "ise", "-p", cpld_fit] + "-ofmt vhdl -optimize speed -htmlrpt -loc on -slew fast -init low -inputs 54 -pterms 25 -unused float -power std -terminate keeper top_level.ngd".split(),
+            ["top_level.ngd"], ["top_level.vm6"]))
+        stages.append((
+            "hprep6", ["hprep6", "-s", "IEEE1149", "-n", "top_level", "-i", "top_level"],
+            ["top_level.vm6"], ["top_level.jed"]))
     else:
+        raise HDLException("The " + boardDir + "/board.cfg describes something which is not recognisable as a Xilinx FPGA or CPLD")
+    boardFiles = [boardDir + "/" + i for i in ("board.ucf", "board.ut") if os.path.exists(boardDir + "/" + i)]
+    reports = ["top_level.syr", "top_level.ngr", "top_level.bld", "top_level_map.mrp", "top_level.par", "top_level.twr", "top_level.bgn", "top_level.rpt"]
+    runPipeline(stages, uniqueHdls + netlists + boardFiles + ["xst/board.xst"], reports)
+
+# Run the Altera synthesis & implementation stages in the current directory, each of which only runs if its own
+# inputs changed. Quartus keeps its netlists in db/, so each stage's report stands in for its output - called by
+# appBuild()
+def alteraBuild(boardDir, uniqueHdls):
+    # Copy board.qsf & board.sdc over
+    shutil.copyfile(boardDir + "/board.qsf", "top_level.qsf")
+    shutil.copyfile(boardDir + "/board.sdc", "top_level.sdc")
+    
+    # Append list of HDLs
+    f = open("top_level.qsf", "a")
+    for i in uniqueHdls:
+        if ( i.endswith(".vhdl") or i.endswith(".vhd") ):
+            f.write("set_global_assignment -name VHDL_FILE " + i + "\n")
+        elif ( i.endswith(".v") ):
+            f.write("set_global_assignment -name VERILOG_FILE " + i + "\n")
+    f.close()
+    
+    # Create top_level.srf file declaring which warnings to ignore
+    f = open("top_level.srf", "w")
+    f.write('{ "Warning" "WCPT_FEATURE_DISABLED_POST" "LogicLock " "Warning (292013): Feature LogicLock is only available with a valid subscription license. You can purchase a software subscription to gain full access to this feature." {  } {  } 0 292013 "Feature %1!s! is only available with a valid subscription license. You can purchase a software subscription to gain full access to this feature." 1 0 "" 0 -1}\n')
+    f.close()
+
+    # Run the build stages. The netlists live in db/, so quartus_map must run again if that's missing
+    stages = [(
+        "quartus_map", ["quartus_map", "--parallel={threads}", "--read_settings_files=on", "--write_settings_files=off", "top_level", "-c", "top_level"],
+        uniqueHdls + ["top_level.qsf", "top_level.srf"], ["top_level.map.rpt", "db"]), (
+        "quartus_fit", ["quartus_fit", "--parallel={threads}", "--read_settings_files=on", "--write_settings_files=off", "top_level", "-c", "top_level"],
+        ["top_level.map.rpt", "top_level.qsf", "top_level.sdc"], ["top_level.fit.rpt"]), (
+        "quartus_asm", ["quartus_asm", "--read_settings_files=on", "--write_settings_files=off", "top_level", "-c", "top_level"],
+        ["top_level.fit.rpt"], ["top_level.sof"])]
+    reports = ["top_level.pof", "top_level.asm.rpt", "top_level.sta.rpt", "top_level.map.summary", "top_level.fit.summary"]
+    runPipeline(stages, uniqueHdls + [boardDir + "/board.qsf", boardDir + "/board.sdc", "top_level.srf"], reports)
+
+# Get the build database for the current directory, loading it if necessary. It records the content hash of every
+# input file (cached against its size, mtime & inode so unchanged files are never re-read) and the fingerprint of the
+# inputs from which each target was last successfully built
+def getBuildDb():
+    cwd = os.getcwd()
+    if ( cwd not in buildDbs ):
+        db = None
+        if ( os.path.exists(buildDbName) ):
+            try:
+                with open(buildDbName, "r") as f:
+                    db = json.load(f)
+            except ValueError:
+                print "Ignoring corrupt " + buildDbName
+        if ( not isinstance(db, dict) ):
+            db = dict()
+        db.setdefault("files", dict())
+        db.setdefault("targets", dict())
+        buildDbs[cwd] = db
+    return buildDbs[cwd]
+
+# Save the current directory's build database, forgetting about files which no longer exist
+def saveBuildDb():
+    db = getBuildDb()
+    files = db["files"]
+    for path in files.keys():
+        if ( not os.path.exists(path) ):
+            del files[path]
+    with atomicWrite(buildDbName) as tmpName:
+        with open(tmpName, "w") as f:
+            json.dump(db, f, indent=1, sort_keys=True)
+
+# Get the SHA-1 of the specified file's content, avoiding reading it if its size, mtime & inode are unchanged
+def hashFile(path):
+    files = getBuildDb()["files"]
+    absPath = os.path.abspath(path)
+    st = os.stat(absPath)
+    stamp = [st.st_size, st.st_mtime, st.st_ino]
+    entry = files.get(absPath)
+    if ( entry and entry[:3] == stamp ):
+        return entry[3]
+    digest = sha1File(absPath)
+    files[absPath] = stamp + [digest]
+    return digest
+
+# Get the SHA-1 of the specified file's content
+def sha1File(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while ( True ):
+            chunk = f.read(1048576)
+            if ( not chunk ):
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+# Get a fingerprint of the content of the specified files and the extra strings (tool flags, generics, etc)
+def getFingerprint(files, extras = []):
+    h = hashlib.sha1()
+    for i in sorted(set(files)):
+        h.update(i + "\0" + hashFile(i) + "\n")
+    for i in extras:
+        h.update("\0" + str(i) + "\n")
+    return h.hexdigest()
+
+# Get the wall-clock limit in seconds of the named tool run: its entry in the "timeouts" map of the hdlmake.cfg in the
+# current directory or its parent (so testbenches & validation inherit the app's), or else the --timeout default. The
+# numbered runs of a rule, e.g. genrule-mcs-2, take the rule's entry
+def getTimeout(name):
+    for baseDir in (None, ".."):
+        tree = readHdlMake(baseDir, False)
+        if ( isinstance(tree, dict) and isinstance(tree.get("timeouts"), dict) ):
+            for i in (name, name.split("-")[0]):
+                if ( i in tree["timeouts"] ):
+                    return int(tree["timeouts"][i])
+    return toolTimeout
+
+# Signal a tool and (except on Windows) everything it started, since the Xilinx tools are wrapper scripts
+def signalTool(proc, force):
+    try:
+        if ( os.name == 'nt' ):
+            proc.kill() if force else proc.terminate()
+        else:
+            os.killpg(proc.pid, signal.SIGKILL if force else signal.SIGTERM)
+    except OSError:
+        pass  # it already finished
+
+# Wait for a tool to finish, returning its exit status. Where possible it's reaped with wait4(), so its own peak RSS
+# can be recorded against the running phases (RUSAGE_CHILDREN only gives the biggest child waited for so far)
+def waitTool(proc):
+    if ( not hasattr(os, "wait4") ):
+        return proc.wait()
+    while ( True ):
+        try:
+            (pid, status, usage) = os.wait4(proc.pid, 0)
+            break
+        except OSError, ex:
+            if ( ex.errno != errno.EINTR ):
+                raise
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    traceChildRss(usage.ru_maxrss // 1024 if ( sys.platform == "darwin" ) else usage.ru_maxrss)
+    return proc.returncode
+
+# Stop a running tool, politely at first, recording why in "stopped" (a list of timers, then the reason)
+def stopTool(proc, stopped, reason):
+    if ( len(stopped) > 1 ):
+        return
+    stopped.append(reason)
+    signalTool(proc, False)
+    killer = threading.Timer(10, signalTool, [proc, True])
+    killer.daemon = True
+    stopped[0].append(killer)
+    killer.start()
+
+# Get the number of job slots shared by everything hdlmake runs on this machine
+def getSlotBudget():
+    if ( slotBudget != None ):
+        return max(1, slotBudget)
+    return max(1, int(os.environ.get("HDLMAKE_SLOTS", "0")) or multiprocessing.cpu_count())
+
+# Hold up to "want" job slots (at least one, waiting for it if need be) for the duration, yielding how many were got.
+# The slots are lock files under the cache directory, so every hdlmake on the machine, with all of its worker processes
+# & threads, shares the one budget, like make's jobserver. A tool run with slots (e.g. a generation rule) passes them on
+# in $HDLMAKE_JOBSLOTS, so an hdlmake it runs uses those rather than waiting for more
+@contextlib.contextmanager
+def jobSlots(want):
+    inherited = os.environ.get("HDLMAKE_JOBSLOTS")
+    if ( inherited ):
+        yield max(1, min(want, int(inherited)))
+        return
+    budget = getSlotBudget()
+    want = max(1, min(want, budget))
+    if ( fcntl == None ):
+        yield want
+        return
+    slotDir = cacheDir + "/slots"
+    mkdir(slotDir)
+    held = []
+    start = time.time()
+    try:
+        while ( True ):
+            for i in range(budget):
+                f = open(slotDir + "/" + str(i), "a")
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    held.append(f)
+                except IOError:
+                    f.close()
+                if ( len(held) == want ):
+                    break
+            if ( held ):
+                break
+            time.sleep(slotPoll)
+        traceNote(slots=len(held), slotWait=round(time.time() - start, 3))
+        yield len(held)
+    finally:
+        for f in held:
+            f.close()  # which releases its lock
+
+# Run the named tool (an argument list, or a shell command for .cfg rules) holding job slots, logging to <name>.log and
+# stopping it at an abortRe line or after getTimeout(name). Returns None, or why it failed
+def runTool(name, cmd, abortRe = fatalErrorRe, cwd = None, echo = True):
+    threads = None
+    if ( not isinstance(cmd, basestring) and any("{threads}" in i for i in cmd) ):
+        threads = toolThreads.get(os.path.basename(cmd[0]), (None, "1"))
+    with jobSlots(1 if ( threads == None ) else threads[0] or getSlotBudget()) as slots:
+        if ( threads ):
+            count = str(slots) if ( slots > 1 ) else threads[1]
+            cmd = [i.replace("{threads}", count) for i in cmd]
+        return runProcess(name, cmd, abortRe, cwd, echo, slots)
+
+# Run a tool holding the specified number of job slots - called by runTool()
+def runProcess(name, cmd, abortRe, cwd, echo, slots):
+    logName = name + ".log" if ( cwd == None ) else cwd + "/" + name + ".log"
+    timeout = getTimeout(name)
+    traceNote(log=logName)
+    sys.stdout.flush()
+    try:
+        # The tool mustn't inherit other threads' slot locks, so it only gets its own output
+        proc = subprocess.Popen(
+            cmd, shell=isinstance(cmd, basestring), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd,
+            env=dict(os.environ, HDLMAKE_JOBSLOTS=str(slots)), close_fds=os.name != 'nt',
+            preexec_fn=None if ( os.name == 'nt' ) else os.setpgrp)
+    except OSError, ex:
+        return "cannot run " + (cmd if isinstance(cmd, basestring) else cmd[0]) + ": " + str(ex)
+    stopped = [[]]
+    if ( timeout ):
+        timer = threading.Timer(timeout, stopTool, [proc, stopped, "timed out after {0}s".format(timeout)])
+        timer.daemon = True
+        stopped[0].append(timer)
+        timer.start()
+    try:
+        with open(logName, "w") as log:
+            for line in iter(proc.stdout.readline, ""):
+                log.write(line)
+                if ( echo ):
+                    sys.stdout.write(line)
+                if ( abortRe and abortRe.match(line) ):
+                    stopTool(proc, stopped, "stopped at: " + line.strip())
+        status = waitTool(proc)
+    except:
+        # Interrupted (the tool is in its own process group, so it didn't see the Ctrl-C)
+        signalTool(proc, True)
+        raise
+    finally:
+        for timer in list(stopped[0]):
+            timer.cancel()
+            timer.join()
+    sys.stdout.flush()
+    if ( len(stopped) > 1 ):
+        return stopped[1] + " (see " + logName + ")"
+    elif ( status ):
+        return "exit status {0} (see {1})".format(status, logName)
+    return None
+
+# Get the fingerprint of a build stage's input file content and command line
+def stageFingerprint(name, cmd, inputs, outputs):
+    return getFingerprint(inputs, [" ".join(cmd)])
+
+# Find out whether a build stage last succeeded with the same inputs & command line, and its outputs all still exist
+def isStageCurrent(name, cmd, inputs, outputs):
+    fingerprint = stageFingerprint(name, cmd, inputs, outputs)
+    return getBuildDb()["targets"].get("stage:" + name) == fingerprint and all(os.path.exists(i) for i in outputs)
+
+# Run a build stage, unless it last succeeded with the same input file content and command line (which covers the
+# FPGA part, flags etc) and its outputs all still exist. Called by runPipeline()
+def runStage(name, cmd, inputs, outputs):
+    with tracePhase(name, "stage"):
+        if ( isStageCurrent(name, cmd, inputs, outputs) ):
+            print "Stage " + name + ": Nothing to do"
+            traceNote(cache="hit")
+            return
+        traceNote(cache="miss")
+        recordBuild("stage:" + name, None)
+        error = runTool(name, cmd)
+        if ( error ):
+            raise HDLException("The " + name + " process failed: " + error)
+        for i in outputs:
+            if ( not os.path.exists(i) ):
+                raise HDLException("The " + name + " process did not produce " + i)
+        recordBuild("stage:" + name, stageFingerprint(name, cmd, inputs, outputs))
+
+# Get the content hash of the named tool's executable, standing in for its version
+def toolDigest(tool):
+    exeName = tool + ".exe" if ( os.name == 'nt' ) else tool
+    for i in os.environ['PATH'].split(os.pathsep):
+        exe = os.path.join(i, exeName)
+        if ( os.path.isfile(exe) ):
+            return hashFile(os.path.realpath(exe))
+    return "missing"
+
+# Get the path to key the artifact cache on: relative to the build directory if it's in it, else relative to the app
+# directory (which is the build directory, except in a matrix build) or topDir ("+/..."), so however a build reaches a
+# file, and in whichever workspace, it's the same
+def keyPath(path):
+    absPath = os.path.realpath(path)
+    for (base, prefix) in ((os.getcwd(), ""), (buildAppDir or os.getcwd(), ""), (topDir, "+/")):
+        base = os.path.realpath(base)
+        if ( absPath.startswith(os.path.join(base, "")) ):
+            return prefix + os.path.relpath(absPath, base).replace("\\", "/")
+    return absPath.replace("\\", "/")
+
+# Get the artifact cache key of a design: the hash of its input file content (the HDLs, board files and generics), the
+# stage command lines and the executables of the tools they run. Paths are keyed with keyPath(), so a plain build, a
+# matrix build and builds in other workspaces or on other machines share keys
+def designKey(stages, designInputs):
+    h = hashlib.sha1()
+    for i in sorted(set(keyPath(i) + "\0" + hashFile(i) for i in designInputs)):
+        h.update(i + "\n")
+    for (name, cmd, inputs, outputs) in stages:
+        args = [keyPath(i) if ( "/" in i or os.path.exists(i) ) else i for i in cmd[1:]]
+        h.update(" ".join([cmd[0]] + args) + "\0" + toolDigest(cmd[0]) + "\n")
+    return h.hexdigest()
+
+# Fetch the artifacts stored under the specified key from the artifact cache (a directory or an HTTP URL) into the
+# current directory, returning False if they're not there. They're extracted into a temporary directory first, so a
+# failed fetch leaves the existing outputs alone
+@traced("artifacts")
+def fetchArtifacts(key):
+    tmpDir = None
+    try:
+        if ( artifactCache.startswith("http://") or artifactCache.startswith("https://") ):
+            try:
+                f = urllib2.urlopen(artifactCache + "/" + key + ".tar.gz")
+            except urllib2.HTTPError, ex:
+                if ( ex.code == 404 ):
+                    return False
+                raise
+            tar = tarfile.open(mode="r|gz", fileobj=f)
+        else:
+            archive = artifactCache + "/" + key[:2] + "/" + key + ".tar.gz"
+            if ( not os.path.exists(archive) ):
+                return False
+            f = open(archive, "rb")
+            tar = tarfile.open(mode="r|gz", fileobj=f)
+        tmpDir = tempfile.mkdtemp(prefix=".artifacts.", dir=".")
+        for member in tar:
+            parts = member.name.split("/")
+            if ( not (member.isfile() or member.isdir()) or member.name.startswith("/") or ".." in parts or "\\" in member.name ):
+                raise HDLException("The artifact archive " + key + " contains an unexpected entry: " + member.name)
+            tar.extract(member, tmpDir)
+        tar.close()
+        f.close()
+        for name in os.listdir(tmpDir):
+            # An output directory (e.g. Quartus' db/) is replaced rather than merged with
+            if ( os.path.isdir(name) and not os.path.islink(name) ):
+                shutil.rmtree(name)
+            elif ( os.path.lexists(name) ):
+                os.remove(name)
+            os.rename(tmpDir + "/" + name, name)
+        return True
+    except (urllib2.URLError, IOError, OSError, tarfile.TarError), ex:
+        print "Warning: cannot fetch " + key + " from the artifact cache: " + str(ex)
+        return False
+    finally:
+        if ( tmpDir ):
+            shutil.rmtree(tmpDir, True)
+
+# Store the specified files in the artifact cache under the specified key
+@traced("artifacts")
+def storeArtifacts(key, files):
+    (fd, tmpName) = tempfile.mkstemp(suffix=".tar.gz")
+    os.close(fd)
+    try:
+        tar = tarfile.open(tmpName, "w:gz")
+        for i in files:
+            tar.add(i)
+        tar.close()
+        if ( artifactCache.startswith("http://") or artifactCache.startswith("https://") ):
+            with open(tmpName, "rb") as f:
+                request = urllib2.Request(artifactCache + "/" + key + ".tar.gz", f.read())
+            request.get_method = lambda: "PUT"
+            urllib2.urlopen(request).close()
+        else:
+            archiveDir = artifactCache + "/" + key[:2]
+            mkdir(archiveDir)
+            archive = archiveDir + "/" + key + ".tar.gz"
+            with atomicWrite(archive) as archiveTmp:
+                shutil.move(tmpName, archiveTmp)
+                os.chmod(archiveTmp, 0666 & ~getUmask())  # mkstemp() made it private
+        print "Stored build outputs in the artifact cache (" + key + ")"
+    except (urllib2.URLError, IOError, OSError, tarfile.TarError), ex:
+        print "Warning: cannot store " + key + " in the artifact cache: " + str(ex)
+    finally:
+        if ( os.path.exists(tmpName) ):
+            os.remove(tmpName)
+
+# Run a pipeline of build stages, each a (name, cmd, inputs, outputs) tuple. If an artifact cache is configured and
+# some stage needs to run, the stage outputs & reports are first looked for in the cache, keyed on designKey(); after
+# a real build they're stored there. Called by xilinxBuild() and alteraBuild()
+@traced("build")
+def runPipeline(stages, designInputs, reports):
+    if ( artifactCache == None or all(isStageCurrent(*i) for i in stages) ):
+        for i in stages:
+            runStage(*i)
+        return
+    key = designKey(stages, designInputs)
+    hit = fetchArtifacts(key)
+    traceNote(cache="hit" if hit else "miss")
+    if ( hit ):
+        print "Restored build outputs from the artifact cache (" + key + ")"
+        for i in stages:
+            if ( all(os.path.exists(j) for j in i[3]) ):
+                recordBuild("stage:" + i[0], stageFingerprint(*i))
+        return
+    for i in stages:
+        runStage(*i)
+    artifacts = []
+    for (name, cmd, inputs, outputs) in stages:
+        artifacts.extend(i for i in outputs if os.path.exists(i) and i not in artifacts)  # including db/
+    artifacts.extend(i for i in reports if os.path.isfile(i) and i not in artifacts)
+    storeArtifacts(key, artifacts)
+
+# Work out whether a build is needed by comparing the fingerprint of its inputs with that of the last good build
+def isBuildNeeded(target, fingerprint):
+    if ( not os.path.exists(target) ):
         return True  # no target yet, must build
+    return getBuildDb()["targets"].get(target) != fingerprint
+
+# Record that the target was successfully built from inputs having the specified fingerprint
+def recordBuild(target, fingerprint):
+    getBuildDb()["targets"][target] = fingerprint
+    saveBuildDb()
+
+# Get the (warn, ignore) sets of message codes for the specified tool ("xst" or "quartus"). Codes in the warn set are
+# reported as warnings, those in the ignore set are dropped, and any other warning is treated as an error. The
+# defaults can be overridden per project in hdlmake.cfg, e.g.:
+#
+#   validation:
+#     xst:
+#       warn: [647]
+#       ignore: [2036]
+#
+def getWarningPolicy(tree, tool):
+    (warnCodes, ignoreCodes) = (warnSet, ignoreSet) if ( tool == "xst" ) else (set(), set())
+    policy = tree.get("validation") if isinstance(tree, dict) else None
+    if ( isinstance(policy, dict) and isinstance(policy.get(tool), dict) ):
+        if ( "warn" in policy[tool] ):
+            warnCodes = set(policy[tool]["warn"] or [])
+        if ( "ignore" in policy[tool] ):
+            ignoreCodes = set(policy[tool]["ignore"] or [])
+    return (warnCodes, ignoreCodes)
+
+# Make an empty validation result for the specified report
+def newReport(reportFile):
+    return {"report": reportFile, "summary": None, "totals": {"error": 0, "warning": 0, "ignored": 0}, "messages": {"error": [], "warning": [], "ignored": []}}
+
+# Parse a tool report in a single streaming pass, classifying each message as an "error", "warning" or "ignored"
+# according to the policy. Identical messages are counted rather than repeated. Returns a dict with the total count
+# and the list of {code, message, file, line, count} for each category, and the groups of the first line matching
+# summaryRe, if given
+def parseReport(reportFile, messageRe, sourceRe, warnCodes, ignoreCodes, summaryRe = None):
+    result = newReport(reportFile)
+    categories = {"error": OrderedDict(), "warning": OrderedDict(), "ignored": OrderedDict()}
+    with open(reportFile, "r") as f:
+        for line in f:
+            m = messageRe.match(line)
+            if ( m == None ):
+                if ( summaryRe and result["summary"] == None ):
+                    m = summaryRe.match(line)
+                    if ( m ):
+                        result["summary"] = m.groups()
+                continue
+            (severity, code, message) = m.group("severity", "code", "message")
+            code = code or ""
+            if ( severity.lower() == "error" ):
+                category = "error"
+            elif ( code in ignoreCodes ):
+                category = "ignored"
+            elif ( code in warnCodes ):
+                category = "warning"
+            else:
+                category = "error"
+            key = (code, message)
+            entry = categories[category].get(key)
+            if ( entry == None ):
+                s = sourceRe.search(message)
+                entry = {"code": code, "message": message, "file": s.group(1) if s else None, "line": int(s.group(2)) if s else None, "count": 0}
+                categories[category][key] = entry
+            entry["count"] += 1
+    for (category, entries) in categories.items():
+        result["messages"][category] = entries.values()
+        result["totals"][category] = sum(i["count"] for i in entries.values())
+    return result
+
+# Write the validation result to validation.json, print its warnings and raise if it has errors. Called by doValidate()
+def reportValidation(result):
+    with open("validation.json", "w") as f:
+        json.dump(result, f, indent=1, sort_keys=True)
+    def fmt(entries):
+        return "".join("\n  {0}: {1}{2}".format(i["code"], i["message"], " (x{0})".format(i["count"]) if i["count"] > 1 else "") for i in entries)
+    totals = result["totals"]
+    messages = result["messages"]
+    if ( totals["warning"] ):
+        if ( totals["ignored"] ):
+            print "\nFound {0} warnings (ignored {1}):{2}\n".format(totals["warning"], totals["ignored"], fmt(messages["warning"]))
+        else:
+            print "\nFound {0} warnings:{1}\n".format(totals["warning"], fmt(messages["warning"]))
+    if ( totals["error"] ):
+        raise HDLException("Found {0} errors:{1}".format(totals["error"], fmt(messages["error"])))
 
 # Validate the syntax of the code in the current directory by running only the synthesis step
+@traced("validate")
 def doValidate(tool):
     # Load the hdlmake.cfg file from the current directory
     varMap = {"board": "sim"}
@@ -357,127 +1732,493 @@ def doValidate(tool):
     for i in uniqueHdls:
         print "  " + i
 
-    if ( isBuildNeeded("synthesis/TIMESTAMP", uniqueHdls) ):
+    policy = getWarningPolicy(tree, "xst" if ( tool == 'x' ) else "quartus")
+    fingerprint = getFingerprint(uniqueHdls, ["validate", tool, sorted(policy[0]), sorted(policy[1])])
+    if ( isBuildNeeded("synthesis/TIMESTAMP", fingerprint) ):
         # Separate directory for synthesis gubbins
         print "HDL validation:"
+        traceNote(cache="miss")
+        recordBuild("synthesis/TIMESTAMP", None)  # until it succeeds
         mkdir("synthesis")
         os.chdir("synthesis")
-        open("TIMESTAMP", "a").close()
-        os.utime("TIMESTAMP", (0, 0))  # set last-mod time to 1970
-
-        topLevel = findTop("../" + topHdl)
-        print "Deduced top-level entity: " + topLevel
-
-        if ( tool == 'x' ):
-            # Create list of HDLs
-            f = open("top_level.prj", "w")
-            for i in uniqueHdls:
-                fn = i if i.startswith(topDir) else "../" + i
-                if ( i.endswith(".vhdl") or i.endswith(".vhd") ):
-                    f.write("vhdl work \"" + fn + "\"\n")
-                elif ( i.endswith(".v") ):
-                    f.write("verilog work \"" + fn + "\"\n")
-            f.close()
+        try:
+            open("TIMESTAMP", "a").close()
+            os.utime("TIMESTAMP", (0, 0))  # set last-mod time to 1970
 
-            # Generate xst file.
-            f = open("top_level.xst", "w")
-            f.write("set -tmpdir \"xst/projnav.tmp\"\n")
-            f.write("set -xsthdpdir \"xst\"\n")
-            f.write("run\n")
-            f.write("-ifn top_level.prj\n")
-            f.write("-ifmt mixed\n")
-            f.write("-ofn " + topLevel + "\n")
-            f.write("-ofmt NGC\n")
-            f.write("-p xc6slx45-2-fgg676\n")
-            f.write("-top " + topLevel + "\n")
-            f.write("-opt_mode Speed\n")
-            f.write("-opt_level 1\n")
-            f.close()
+            topLevel = findTop("../" + topHdl)
+            print "Deduced top-level entity: " + topLevel
+
+            if ( tool == 'x' ):
+                # Create list of HDLs
+                f = open("top_level.prj", "w")
+                for i in uniqueHdls:
+                    fn = i if i.startswith(topDir) else "../" + i
+                    if ( i.endswith(".vhdl") or i.endswith(".vhd") ):
+                        f.write("vhdl work \"" + fn + "\"\n")
+                    elif ( i.endswith(".v") ):
+                        f.write("verilog work \"" + fn + "\"\n")
+                f.close()
+
+                # Generate xst file.
+                f = open("top_level.xst", "w")
+                f.write("set -tmpdir \"xst/projnav.tmp\"\n")
+                f.write("set -xsthdpdir \"xst\"\n")
+                f.write("run\n")
+                f.write("-ifn top_level.prj\n")
+                f.write("-ifmt mixed\n")
+                f.write("-ofn " + topLevel + "\n")
+                f.write("-ofmt NGC\n")
+                f.write("-p xc6slx45-2-fgg676\n")
+                f.write("-top " + topLevel + "\n")
+                f.write("-opt_mode Speed\n")
+                f.write("-opt_level 1\n")
+                f.close()
         
-            # Run the build steps
-            mkdir("xst/projnav.tmp")
-            if ( os.system("xst -intstyle ise -ifn top_level.xst -ofn top_level.syr") ):
-                raise HDLException("The xst process failed")
-
-            # Extract warning info
-            f = open(topLevel + "_xst.xrpt", "r")
-            m = None
-            while ( m == None ):
-                l = f.readline()
-                if ( l == "" ):
+                # Run the build steps
+                mkdir("xst/projnav.tmp")
+                with tracePhase("xst", "validate"):
+                    error = runTool("xst", ["xst", "-intstyle", "ise", "-ifn", "top_level.xst", "-ofn", "top_level.syr"])
+                    if ( error ):
+                        raise HDLException("The xst process failed: " + error)
+
+                # Extract warning info; the .xrpt has the warning count, so only parse the .syr if there are some
+                warnCount = None
+                with open(topLevel + "_xst.xrpt", "r") as f:
+                    for l in f:
+                        m = xrptWarningsRe.search(l)
+                        if ( m ):
+                            warnCount = m.group(1)
+                            break
+                if ( warnCount == None ):
                     raise HDLException("Report file is missing warning information")
-                m = re.search(r"XST_NUMBER_OF_WARNINGS\" value=\"(\d+)\"", l)
-            f.close()
-            if ( m.group(1) != "0" ):
-                warnCount = 0
-                errCount = 0
-                ignoreCount = 0
-                warnMsgs = ""
-                errMsgs = ""
-                f = open("top_level.syr", "r")
-                m = None
-                l = f.readline()
-                while ( l != "" ):
-                    m = re.search(r"^WARNING:[A-Za-z]+:(\d+)\s+-\s+(.*?)$", l)
-                    if ( m != None ):
-                        code = m.group(1)
-                        msg = m.group(2)
-                        if ( code in warnSet ):
-                            warnCount += 1
-                            warnMsgs += "\n  " + code + ": " + msg
-                        elif ( code not in ignoreSet ):
-                            errCount += 1
-                            errMsgs += "\n  " + code + ": " + msg
-                        else:
-                            ignoreCount += 1
-                    l = f.readline()
+                if ( warnCount != "0" ):
+                    reportValidation(parseReport("top_level.syr", xstMessageRe, xstSourceRe, policy[0], policy[1]))
+                else:
+                    reportValidation(newReport("top_level.syr"))
+            elif ( tool == 'a' ):
+                # Generate qsf file
+                f = open("top_level.qsf", "w")
+                f.write("set_global_assignment -name FAMILY \"Cyclone II\"\n")
+                f.write("set_global_assignment -name DEVICE EP2C5T144C8\n")
+                f.write("set_global_assignment -name TOP_LEVEL_ENTITY " + topLevel + "\n")
+
+                for i in uniqueHdls:
+                    fn = (i if i.startswith(topDir) else "../" + i)
+                    if ( i.endswith(".vhdl") or i.endswith(".vhd") ):
+                        f.write("set_global_assignment -name VHDL_FILE " + fn + "\n")
+                    elif ( i.endswith(".v") ):
+                        f.write("set_global_assignment -name VERILOG_FILE " + fn + "\n")
                 f.close()
-                if ( warnCount ):
-                    if ( ignoreCount ):
-                        print "\nFound {0} warnings (ignored {1}):{2}\n".format(warnCount, ignoreCount, warnMsgs)
-                    else:
-                        print "\nFound {0} warnings:{1}\n".format(warnCount, warnMsgs)
-                if ( errCount ):
-                    raise HDLException("Found {0} errors:{1}".format(errCount, errMsgs))
-        elif ( tool == 'a' ):
-            # Generate qsf file
-            f = open("top_level.qsf", "w")
-            f.write("set_global_assignment -name FAMILY \"Cyclone II\"\n")
-            f.write("set_global_assignment -name DEVICE EP2C5T144C8\n")
-            f.write("set_global_assignment -name TOP_LEVEL_ENTITY " + topLevel + "\n")
-
-            for i in uniqueHdls:
-                fn = (i if i.startswith(topDir) else "../" + i)
-                if ( i.endswith(".vhdl") or i.endswith(".vhd") ):
-                    f.write("set_global_assignment -name VHDL_FILE " + fn + "\n")
-                elif ( i.endswith(".v") ):
-                    f.write("set_global_assignment -name VERILOG_FILE " + fn + "\n")
-            f.close()
 
-            # Run the build:
-            if ( os.system("quartus_map --parallel=1 --read_settings_files=on --write_settings_files=off top_level -c top_level") ):
-                raise HDLException("The quartus_map process failed")
+                # Run the build:
+                with tracePhase("quartus_map", "validate"):
+                    error = runTool("quartus_map", ["quartus_map", "--parallel={threads}", "--read_settings_files=on", "--write_settings_files=off", "top_level", "-c", "top_level"])
+                    if ( error ):
+                        raise HDLException("The quartus_map process failed: " + error)
 
-            # Extract warning info
-            f = open("top_level.map.rpt", "r")
-            m = None
-            while ( m == None ):
-                l = f.readline()
-                if ( l == "" ):
+                # Extract warning info
+                result = parseReport("top_level.map.rpt", quartusMessageRe, quartusSourceRe, policy[0], policy[1], quartusSummaryRe)
+                if ( result["summary"] == None ):
                     raise HDLException("Report file is missing warning information")
-                m = re.search(r"^Info: Quartus II Analysis & Synthesis was successful. (\d+) errors, (\d+) warnings", l)
-            f.close()
-            errCount = m.group(1)
-            warnCount = m.group(2)
-            if ( warnCount != "0" or errCount != "0" ):
-                raise HDLException("Found {0} errors and {1} warnings".format(errCount, warnCount))
-        else:
-            raise HDLException("Unsupported validation tool: " + tool)
+                (errCount, warnCount) = result["summary"]
+                if ( (errCount != "0" or warnCount != "0") and not any(result["totals"].values()) ):
+                    # The summary counts messages which weren't listed in the report
+                    raise HDLException("Found {0} errors and {1} warnings".format(errCount, warnCount))
+                reportValidation(result)
+            else:
+                raise HDLException("Unsupported validation tool: " + tool)
         
-        os.utime("TIMESTAMP", None)  # set last-mod time to now
-        os.chdir("..")
+            os.utime("TIMESTAMP", None)  # set last-mod time to now
+        finally:
+            os.chdir("..")
+        recordBuild("synthesis/TIMESTAMP", fingerprint)
     else:
         print "HDL validation: Nothing to do"
+        traceNote(cache="hit")
+
+# Work out the order in which the specified HDL files must be analysed and which of the others each one depends on,
+# from the design units they declare, use and instantiate
+#
+def hdlDependencies(hdls):
+    provides = dict()
+    for hdl in hdls:
+        index = indexHdl(hdl)
+        if ( index ):
+            for (kind, name, entity) in index["units"]:
+                if ( kind in ("entity", "package", "configuration", "module") ):
+                    provides.setdefault(name.lower(), hdl)
+    deps = dict()
+    for hdl in hdls:
+        deps[hdl] = []
+        index = indexHdl(hdl)
+        if ( index ):
+            names = [u for (lib, u) in index["uses"] if lib == "work"]
+            names.extend(u for (lib, u) in index["instances"] if lib in ("", "work"))
+            names.extend(entity for (kind, name, entity) in index["units"] if entity)
+            for name in names:
+                dep = provides.get(name.lower())
+                if ( dep and dep != hdl and dep not in deps[hdl] ):
+                    deps[hdl].append(dep)
+
+    # Depth-first, so each file comes after everything it depends on; cycles (legal with components) are broken
+    order = []
+    done = set()
+    for root in hdls:
+        if ( root in done ):
+            continue
+        active = set([root])
+        stack = [(root, iter(deps[root]))]
+        while ( stack ):
+            (hdl, it) = stack[-1]
+            dep = next((i for i in it if i not in done and i not in active), None)
+            if ( dep == None ):
+                stack.pop()
+                active.discard(hdl)
+                done.add(hdl)
+                order.append(hdl)
+            else:
+                active.add(dep)
+                stack.append((dep, iter(deps[dep])))
+    return (order, deps)
+
+# Get the shared, precompiled work library holding the specified HDLs from libs/ (in dependency order), analysing them
+# into the cache if they're not there yet. It's keyed on the files' paths & content, the GHDL flags and the GHDL
+# executable. If they can't be analysed on their own, there's no seed and they're analysed with the rest. Called by
+# ghdlAnalyse() and runTestbenches()
+#
+def ghdlSeed(libHdls, digests):
+    h = hashlib.sha1()
+    h.update(ghdlFlags + "\0" + toolDigest("ghdl") + "\n")
+    for i in sorted(libHdls):
+        h.update(i + "\0" + digests[i] + "\n")
+    key = h.hexdigest()
+    seedDir = cacheDir + "/ghdl/" + key
+    if ( not os.path.isdir(seedDir) ):
+        mkdir(cacheDir + "/ghdl")
+        tmpDir = tempfile.mkdtemp(prefix=".tmp.", dir=cacheDir + "/ghdl")
+        try:
+            print "HDL analysis: precompiling {0} library files".format(len(libHdls))
+            flags = ["--workdir=" + tmpDir if ( i == "--workdir=simulation" ) else i for i in ghdlFlags.split()]
+            with tracePhase("precompile", "sim", {"files": len(libHdls)}):
+                error = runTool("precompile", ["ghdl", "-a"] + flags + libHdls, None)
+            if ( error ):
+                print "Warning: cannot precompile the libraries (" + error + "), so analysing them with the rest"
+                return (None, None)
+            try:
+                os.rename(tmpDir, seedDir)
+            except OSError:
+                if ( not os.path.isdir(seedDir) ):
+                    raise
+                # else another testbench precompiled the same libraries first
+        finally:
+            shutil.rmtree(tmpDir, True)
+    else:
+        traceNote(seed="hit")
+    return (key, seedDir)
+
+# Analyse the specified HDLs into the simulation work library, which is kept between runs. The HDLs from libs/ never
+# depend on the others, so they're analysed just once into a shared precompiled work library (see ghdlSeed()) which
+# the work library is started from. Of the rest, only files which changed since they were last analysed, and the files
+# which depend on them, are re-analysed, in dependency order. The work library starts afresh if the flags or the
+# libraries change, or a file is dropped. If the analysis fails, perhaps because the order is wrong, GHDL is left to
+# work the order out itself by importing the files & making the top-level unit. Called by topBuild()
+#
+@traced("sim")
+def ghdlAnalyse(hdls, topLevel):
+    (order, deps) = hdlDependencies(hdls)
+    digests = dict((i, hashFile(i)) for i in hdls)
+    libHdls = [i for i in order if i.startswith(topDir + "/libs/")]
+    (seedKey, seedDir) = ghdlSeed(libHdls, digests) if ( libHdls ) else (None, None)
+    db = getBuildDb()
+    state = db.get("analysis")
+    if ( state == None or state["flags"] != ghdlFlags or state.get("seed") != seedKey or not set(state["files"]).issubset(hdls) or not glob.glob("simulation/work-obj*.cf") ):
+        if ( os.path.exists("simulation") ):
+            shutil.rmtree("simulation")
+        state = {"flags": ghdlFlags, "seed": seedKey, "files": dict()}
+        db["analysis"] = state
+        if ( seedDir ):
+            # Copy rather than link, since analysis rewrites the library files
+            shutil.copytree(seedDir, "simulation")
+            for i in libHdls:
+                state["files"][i] = digests[i]
+    mkdir("simulation")
+
+    reverseDeps = dict()
+    for hdl in hdls:
+        for dep in deps[hdl]:
+            reverseDeps.setdefault(dep, []).append(hdl)
+    stale = set(i for i in hdls if state["files"].get(i) != digests[i])
+    todo = list(stale)
+    while ( todo ):
+        for hdl in reverseDeps.get(todo.pop(), []):
+            if ( hdl not in stale ):
+                stale.add(hdl)
+                todo.append(hdl)
+    traceNote(files=len(hdls), stale=len(stale))
+    if ( not stale ):
+        print "HDL analysis: Nothing to do"
+        return
+
+    analyse = [i for i in order if i in stale]
+    print "HDL analysis: {0} of {1} files".format(len(analyse), len(hdls))
+    for i in analyse:
+        state["files"].pop(i, None)
+    error = runTool("analyse", ["ghdl", "-a"] + ghdlFlags.split() + analyse, None)
+    if ( error ):
+        print "HDL analysis: falling back to ghdl -i & ghdl -m"
+        makeError = runTool("import", ["ghdl", "-i"] + ghdlFlags.split() + analyse, None)
+        if ( not makeError ):
+            makeError = runTool("make", ["ghdl", "-m"] + ghdlFlags.split() + [topLevel], None)
+        if ( makeError ):
+            saveBuildDb()
+            raise HDLException("The ghdl analysis failed: " + error + "; so did ghdl -m: " + makeError)
+    for i in analyse:
+        state["files"][i] = digests[i]
+    saveBuildDb()
+
+# Get the line of the file starting at the specified offset, shortened for an error message
+def lineAt(fileName, offset):
+    with open(fileName, "rb") as f:
+        f.seek(offset)
+        line = f.readline(200).rstrip("\r\n")
+    return repr(line[:60] + ("..." if len(line) > 60 else ""))
+
+# Compare two files block by block, returning None if they're identical, or else where they first differ
+def compareExact(expectedFile, resultFile):
+    blockSize = 4194304
+    offset = 0
+    lineNum = 1
+    lineStart = 0
+    with open(expectedFile, "rb") as e, open(resultFile, "rb") as r:
+        while ( True ):
+            a = e.read(blockSize)
+            b = r.read(blockSize)
+            if ( a == b ):
+                if ( not a ):
+                    return None
+                lineNum += a.count("\n")
+                nl = a.rfind("\n")
+                if ( nl >= 0 ):
+                    lineStart = offset + nl + 1
+                offset += len(a)
+                continue
+
+            # Bisect to find the first differing byte
+            lo = 0
+            hi = min(len(a), len(b))
+            while ( lo < hi ):
+                mid = (lo + hi) // 2
+                if ( a[lo:mid + 1] == b[lo:mid + 1] ):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            prefix = a[:lo]
+            lineNum += prefix.count("\n")
+            nl = prefix.rfind("\n")
+            if ( nl >= 0 ):
+                lineStart = offset + nl + 1
+            offset += lo
+            if ( lo == len(a) ):
+                detail = "expected ends, got " + lineAt(resultFile, lineStart)
+            elif ( lo == len(b) ):
+                detail = "expected " + lineAt(expectedFile, lineStart) + ", got end of file"
+            else:
+                detail = "expected " + lineAt(expectedFile, lineStart) + ", got " + lineAt(resultFile, lineStart)
+            return "line {0} (byte {1}): {2}".format(lineNum, offset, detail)
+
+# Yield the (line number, line) pairs of a file, skipping lines matching "ignore" and blanking the parts of the
+# rest matching "mask"
+def filteredLines(fileName, ignore, mask):
+    with open(fileName, "rb") as f:
+        for (lineNum, line) in enumerate(f, 1):
+            line = line.rstrip("\r\n")
+            if ( ignore and ignore.search(line) ):
+                continue
+            if ( mask ):
+                line = mask.sub("*", line)
+            yield (lineNum, line)
+
+# Compare two files line by line under the testbench's tolerance rules, returning None if they match, or else where
+# they first differ
+def compareFiltered(expectedFile, resultFile, ignore, mask):
+    for (e, r) in itertools.izip_longest(filteredLines(expectedFile, ignore, mask), filteredLines(resultFile, ignore, mask)):
+        if ( e == None ):
+            return "line {0}: expected ends, got {1}".format(r[0], repr(r[1][:60]))
+        elif ( r == None ):
+            return "line {0}: expected {1}, got end of file".format(e[0], repr(e[1][:60]))
+        elif ( e[1] != r[1] ):
+            where = str(e[0]) if ( e[0] == r[0] ) else "{0} (got line {1})".format(e[0], r[0])
+            return "line {0}: expected {1}, got {2}".format(where, repr(e[1][:60]), repr(r[1][:60]))
+    return None
+
+# Get the (expected, result) file pairs to compare: each expected .sim file goes with results.sim, and each *.sim in an
+# expected directory with its namesake in results/, under the specified results directory
+def resultPairs(expected, resultDir = None):
+    base = "" if ( resultDir == None ) else resultDir + "/"
+    pairs = []
+    for i in expected:
+        if ( os.path.isdir(i) ):
+            pairs.extend((j, base + "results/" + os.path.basename(j)) for j in sorted(glob.glob(i + "/*.sim")))
+        elif ( os.path.exists(i) ):
+            pairs.append((i, base + "results.sim"))
+    return pairs
+
+# Compare the simulation results with the expected results: by default expected.sim with results.sim and each
+# expected/*.sim with its results/*.sim, several pairs at a time. The testbench's hdlmake.cfg may make the comparison
+# tolerant, e.g.:
+#
+#   compare:
+#     ignore: ["^#"]          # skip lines matching any of these
+#     mask: ["@\\d+ns"]        # and don't compare the parts of lines matching any of these
+#
+# Every mismatch is reported, with where the files first differ. Called by topBuild() and runSweep()
+def compareResults(tbTree, pairs = None):
+    if ( pairs == None ):
+        pairs = resultPairs(["expected.sim", "expected"])
+    if ( not pairs ):
+        return
+    rules = tbTree.get("compare") or dict()
+    (ignore, mask) = [rules.get(i) or [] for i in ("ignore", "mask")]
+    (ignore, mask) = [re.compile("|".join("(?:" + j + ")" for j in ([i] if isinstance(i, basestring) else i))) if i else None for i in (ignore, mask)]
+    def compare(pair):
+        (expectedFile, resultFile) = pair
+        if ( not os.path.exists(resultFile) ):
+            return resultFile + " is missing"
+        diff = compareExact(expectedFile, resultFile)
+        if ( diff != None and (ignore or mask) ):
+            # Only identical files can skip the slower line-by-line comparison
+            diff = compareFiltered(expectedFile, resultFile, ignore, mask)
+        return None if ( diff == None ) else resultFile + " differs from " + expectedFile + " at " + diff
+    pool = ThreadPool(min(len(pairs), max(getJobCount(), 4)))
+    try:
+        errors = [i for i in pool.map(compare, pairs) if i]
+    finally:
+        pool.close()
+        pool.join()
+    if ( errors ):
+        raise HDLException("\n  ".join(["The simulation produced unexpected results in {0} of {1} files:".format(len(errors), len(pairs))] + errors))
+
+# Find out whether the yes/no setting in the hdlmake.cfg tree is turned on
+def isEnabled(tree, key):
+    return str(tree.get(key, "")).lower() in ("yes", "true", "on", "1")
+
+# Run the elaborated testbench, either in the testbench directory or, for one of its sweep runs, in the run's directory
+# with the run's generics. Waves are only dumped (to <tb>.ghw in simulation/ or the run's directory) when asked for,
+# since they can cost more than the simulation itself; if the testbench's hdlmake.cfg has "waveSubset: yes" only the
+# signals in its "signals" list are dumped. Called by topBuild() and runSweep()
+def runSimulation(tbTree, tbTopLevel, stopTime, waves, run = None):
+    if ( run == None ):
+        (cwd, outDir) = (None, "simulation")
+        cmd = ["./simulation/" + tbTopLevel, "--stop-time=" + stopTime]
+    else:
+        (cwd, outDir) = (run["dir"], run["dir"])
+        cmd = ["../../simulation/" + tbTopLevel, "--stop-time=" + stopTime] + run["generics"]
+    ghwFile = outDir + "/" + tbTopLevel + ".ghw"
+    if ( waves ):
+        cmd.append("--wave=" + os.path.relpath(ghwFile, cwd or "."))
+        if ( isEnabled(tbTree, "waveSubset") and "signals" in tbTree ):
+            # GTKWave's "top.tb.dut.sig[7:0]" is GHDL's "/tb/dut/sig"
+            f = open(outDir + "/waves.opt", "w")
+            f.write("$ version 1.1\n")
+            for i in tbTree["signals"]:
+                if ( i != "---" ):
+                    path = re.sub(r"[\[(].*$", "", i.lower())
+                    if ( path.startswith("top.") ):
+                        path = path[4:]
+                    f.write("/" + path.replace(".", "/") + "\n")
+            f.close()
+            cmd.append("--read-wave-opt=" + os.path.relpath(outDir + "/waves.opt", cwd or "."))
+    elif ( os.path.exists(ghwFile) ):
+        os.remove(ghwFile)  # it would no longer match the results
+    with tracePhase("simulate", "sim", {"waves": waves}):
+        error = runTool("simulate", cmd, None, cwd, run == None)
+        if ( error ):
+            raise HDLException("The ghdl simulation failed: " + error)
+
+# Get the stimulus sweep declared in the testbench's hdlmake.cfg, if any: the elaborated testbench is run once for each
+# entry, e.g.:
+#
+#   runs:
+#     - name: short                   # run in runs/short/ (default: the entry's number)
+#       stimulus: sets/short          # linked in as the run's stimulus/ (default: stimulus)
+#       expected: sets/short.exp      # a directory of .sim files, or one .sim file (default: expected/ & expected.sim)
+#       generics: {COUNT: 8}          # top-level generic overrides, passed as -gCOUNT=8
+#       stopTime: 100us               # default: the testbench's stopTime
+#
+def getRuns(tbTree, stopTime):
+    runs = []
+    for (n, i) in enumerate(tbTree.get("runs") or [], 1):
+        if ( not isinstance(i, dict) ):
+            raise HDLException("Each entry in the runs list must be a map")
+        name = str(i.get("name", n))
+        if ( not re.match(r"^[\w.-]+$", name) or name in [j["name"] for j in runs] ):
+            raise HDLException("Bad or duplicate run name: " + name)
+        stimulus = i.get("stimulus", "stimulus")
+        if ( "stimulus" in i and not os.path.isdir(stimulus) ):
+            raise HDLException("The stimulus directory of run " + name + " does not exist: " + stimulus)
+        runs.append({
+            "name": name,
+            "dir": "runs/" + name,
+            "stimulus": stimulus,
+            "expected": [i["expected"]] if ( "expected" in i ) else ["expected.sim", "expected"],
+            "generics": ["-g{0}={1}".format(k, v) for (k, v) in sorted((i.get("generics") or dict()).items())],
+            "stopTime": str(i.get("stopTime", stopTime))})
+    return runs
+
+# Get the stimulus & expected files of a sweep run, which its results depend on
+def runInputs(run):
+    return treeFiles(run["stimulus"]) + [i for (i, j) in resultPairs(run["expected"])]
+
+# Run the elaborated testbench once for each of its sweep runs, several at a time, each in its own runs/<name>/
+# directory with its stimulus linked in, and compare each run's results with its expected results; a run whose results
+# differ is rerun with waves to help find the problem. Finish with a table of the results. Called by topBuild()
+def runSweep(tbTree, tbTopLevel, runs, waves):
+    def sweep(run):
+        start = time.time()
+        with tracePhase("run", "sim", {"run": run["name"]}):
+            try:
+                if ( os.path.exists(run["dir"]) ):
+                    shutil.rmtree(run["dir"])
+                mkdir(run["dir"] + "/results")
+                if ( os.path.isdir(run["stimulus"]) ):
+                    if ( os.name == 'nt' ):
+                        shutil.copytree(run["stimulus"], run["dir"] + "/stimulus")
+                    else:
+                        os.symlink(os.path.relpath(run["stimulus"], run["dir"]), run["dir"] + "/stimulus")
+                runSimulation(tbTree, tbTopLevel, run["stopTime"], waves, run)
+                try:
+                    compareResults(tbTree, resultPairs(run["expected"], run["dir"]))
+                except HDLException:
+                    if ( not waves ):
+                        try:
+                            runSimulation(tbTree, tbTopLevel, run["stopTime"], True, run)
+                        except HDLException:
+                            pass
+                    raise
+                return (None, time.time() - start)
+            except HDLException, ex:
+                return (str(ex), time.time() - start)
+
+    print "Running {0} stimulus sets".format(len(runs))
+    pool = ThreadPool(min(len(runs), max(getJobCount(), multiprocessing.cpu_count())))
+    try:
+        results = pool.map(sweep, runs)
+    finally:
+        pool.close()
+        pool.join()
+
+    print "[Run summary]"
+    failCount = 0
+    for (run, (error, elapsed)) in zip(runs, results):
+        if ( error ):
+            failCount += 1
+            print "  FAIL {0:<24} {1:>8.1f}s  {2}".format(run["name"], elapsed, error.replace("\n", "\n     "))
+            if ( not waves and os.path.exists(run["dir"] + "/" + tbTopLevel + ".ghw") ):
+                print "       Waves are in " + run["dir"] + "/" + tbTopLevel + ".ghw"
+        else:
+            print "  PASS {0:<24} {1:>8.1f}s".format(run["name"], elapsed)
+    if ( failCount ):
+        raise HDLException("{0} of {1} runs failed".format(failCount, len(runs)))
 
 # Delete wildcards
 def wildcardDelete(wildcard):
@@ -488,93 +2229,577 @@ def wildcardDelete(wildcard):
         else:
             os.remove(i)
 
-# Do whatever in each testbench directory
-def foreachTestbench(func):
-    testBenches = glob.glob("tb_*")
+# Get the number of parallel jobs requested with -j
+def getJobCount():
+    if ( argList and argList.j ):
+        return max(1, argList.j[0])
+    return 1
+
+# Get the settings from the command line & the run so far which a worker process needs, for initWorker()
+def workerSettings():
+    return {
+        "argList": argList, "appContext": appContext, "offline": offline, "artifactCache": artifactCache,
+        "toolTimeout": toolTimeout, "slotBudget": slotBudget, "traceStart": traceStart}
+
+# Set up a worker process. A forked worker already has the parent's settings, but on Windows workers are spawned
+# afresh, so they're given them. Workers don't see Ctrl-C; the parent deals with it and terminates the pool, upon which
+# a worker exits via runTool() so its tool is stopped too
+def initWorker(settings):
+    globals().update(settings)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(1))
+
+# Call func(*args) in the absolute directory "baseDir", capturing everything written to stdout and stderr (including the
+# output of child processes) in a temporary file. Returns (error, log, events), where events are the phases it traced.
+# Runs in a worker process, so the chdir() is private to it. Called by testbenchWorker() and matrixWorker()
+def runCaptured(baseDir, func, *args):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    logFile = tempfile.TemporaryFile()
+    savedOut = os.dup(1)
+    savedErr = os.dup(2)
+    os.dup2(logFile.fileno(), 1)
+    os.dup2(logFile.fileno(), 2)
+    error = None
+    mark = len(traceEvents)
+    try:
+        os.chdir(baseDir)
+        func(*args)
+    except HDLException, ex:
+        error = str(ex)
+    except Exception:
+        error = traceback.format_exc().strip()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(savedOut, 1)
+        os.dup2(savedErr, 2)
+        os.close(savedOut)
+        os.close(savedErr)
+    logFile.seek(0)
+    log = logFile.read()
+    logFile.close()
+    return (error, log, traceEvents[mark:])
+
+# Build the testbench in the absolute directory "tbDir". Called by runTestbenches(), which adds the phases traced by
+# the worker to its own
+def testbenchWorker(tbDir):
+    return (tbDir,) + runCaptured(tbDir, topBuild)
+
+# Run the worker function on each of the items in a pool of up to "jobs" worker processes, yielding the results as they
+# finish. On Ctrl-C the workers are terminated
+def poolResults(worker, items, jobs):
+    sys.stdout.flush()
+    pool = multiprocessing.Pool(min(jobs, len(items)), initWorker, (workerSettings(),))
+    try:
+        for result in pool.imap_unordered(worker, items):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+# Resolve the app in the current directory once for all of its testbenches, which then use its HDL list rather than
+# each resolving (and validating) the app again. Worker processes inherit it. Called by runTestbenches(), after any
+# validation
+def setAppContext():
+    global appContext
+    (appTop, appHdls) = getDependencies(readHdlMake(None), None, {"board": "sim"})
+    appContext = {"dir": os.getcwd(), "hdls": appHdls}
+
+# Get the runtime history of the current (app) directory's testbenches, forgetting those which no longer exist. It's
+# kept apart from the build database, so cleaning doesn't lose it
+def getTestbenchHistory():
+    history = None
+    if ( os.path.exists(historyName) ):
+        try:
+            with open(historyName, "r") as f:
+                history = json.load(f)
+        except ValueError:
+            print "Ignoring corrupt " + historyName
+    if ( not isinstance(history, dict) ):
+        history = getBuildDb().pop("history", None) or dict()  # where it used to be kept
+    for tb in history.keys():
+        if ( not os.path.isdir(tb) ):
+            del history[tb]
+    return history
+
+# Order the testbenches longest-expected-first, so a long one doesn't start last and hold up the whole run. Those with
+# no history yet go first, since they may be long; with --fail-fast those which failed last time go before them all
+def scheduleTestbenches(testBenches, history):
+    def key(tb):
+        entry = history.get(tb)
+        if ( entry == None ):
+            return (1, -float("inf"))
+        failedFirst = 0 if ( argList and argList.fail_fast and entry.get("failed") ) else 1
+        return (failedFirst, -((entry.get("compile") or 0) + (entry.get("simulate") or 0)))
+    return sorted(testBenches, key=key)
+
+# Save the testbench runtime history
+def saveTestbenchHistory(history):
+    with atomicWrite(historyName) as tmpName:
+        with open(tmpName, "w") as f:
+            json.dump(history, f, indent=1, sort_keys=True)
+
+# Record how long the testbench took to compile & simulate, from the phases it traced, and whether it failed. If it
+# was up to date and didn't run a phase, the phase keeps its previous duration
+def recordTestbench(history, tb, events, error):
+    entry = history.setdefault(tb, {"compile": None, "simulate": None})
+    for (field, names) in (("compile", ("ghdlAnalyse", "elaborate")), ("simulate", ("simulate",))):
+        phases = [i for i in events if i["name"] in names]
+        if ( phases ):
+            # Sweep runs overlap, so take the span rather than the sum
+            span = max(i["ts"] + i["dur"] for i in phases) - min(i["ts"] for i in phases)
+            entry[field] = round(span / 1000000.0, 3)
+    entry["failed"] = error != None
+
+# Build every testbench in the current directory, or just the named ones, longest-expected-first; with -j N they run N
+# at a time in worker processes, with the output of each one printed when it finishes, followed by a pass/fail summary.
+# With --fail-fast, no more are started after one fails
+@traced("sim")
+def runTestbenches(testBenches = None):
+    jobs = getJobCount()
+    if ( testBenches == None ):
+        testBenches = sorted(glob.glob("tb_*"))
+    history = getTestbenchHistory()
+    schedule = scheduleTestbenches(testBenches, history)
+    if ( testBenches ):
+        setAppContext()
+    if ( jobs == 1 or len(testBenches) < 2 ):
+        for tb in schedule:
+            mark = len(traceEvents)
+            error = "interrupted"
+            os.chdir(tb)
+            try:
+                topBuild()
+                error = None
+            except HDLException, ex:
+                error = str(ex)
+                raise
+            finally:
+                os.chdir("..")
+                recordTestbench(history, tb, traceEvents[mark:], error)
+                saveTestbenchHistory(history)
+        return
+
+    # Precompile the app's libraries, rather than have the workers race to
+    libHdls = [i for i in appContext["hdls"] if i.startswith(topDir + "/libs/")]
+    if ( libHdls ):
+        ghdlSeed(hdlDependencies(libHdls)[0], dict((i, hashFile(i)) for i in libHdls))
+
+    cwd = os.getcwd()
+    tbDirs = [cwd + "/" + tb for tb in schedule]
+    results = dict()
+    workers = poolResults(testbenchWorker, tbDirs, jobs)
+    try:
+        for (tbDir, error, log, events) in workers:
+            traceEvents.extend(events)
+            sys.stdout.write(log)
+            if ( error ):
+                print "ERROR: " + error
+            sys.stdout.flush()
+            tb = os.path.basename(tbDir)
+            results[tb] = error
+            recordTestbench(history, tb, events, error)
+            if ( error and argList.fail_fast ):
+                break
+    finally:
+        workers.close()  # terminates any still running
+        saveTestbenchHistory(history)
+
+    print "[Testbench summary]"
+    failCount = 0
     for tb in testBenches:
-        os.chdir(tb)
-        func()
-        os.chdir("..")
+        if ( tb not in results ):
+            print "  SKIP " + tb
+            continue
+        error = results[tb]
+        if ( error ):
+            failCount += 1
+            print "  FAIL " + tb + ": " + error.splitlines()[-1]
+        else:
+            print "  PASS " + tb
+    if ( failCount ):
+        raise HDLException("{0} of {1} testbenches failed".format(failCount, len(testBenches)))
+
+# Forget what was resolved from the specified (absolute) hdlmake.cfg files, and from everything depending on them, so it
+# is resolved afresh from the new config while the rest of the graph is kept. Called by watchBuild()
+def forgetConfigs(cfgFiles):
+    stale = set(os.path.dirname(i) for i in cfgFiles)
+    for i in cfgFiles:
+        cfgCache.pop(i, None)
+    graph = getLibraryGraph()
+    for (topHdl, hdls, node) in depCache.values():
+        graph.setdefault(node["dir"], set()).update(node["deps"])
+    growing = True
+    while ( growing ):
+        growing = False
+        for (libDir, deps) in graph.items():
+            if ( libDir not in stale and not stale.isdisjoint(deps) ):
+                stale.add(libDir)
+                growing = True
+    for (key, node) in libGraph.items():
+        if ( node["dir"] in stale ):
+            del libGraph[key]
+    for (key, value) in depCache.items():
+        if ( value[2]["dir"] in stale ):
+            del depCache[key]
+
+# Get the absolute paths of the HDLs and hdlmake.cfg files the simulation of the specified directory depends on,
+# resolving them if necessary. Called by watchTargets()
+def dependencyFiles(directory):
+    varMap = {"board": "sim"}
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        (topHdl, hdls) = getDependencies(readHdlMake(None), None, varMap)
+        node = depCache[(os.getcwd(), None, varKey(varMap))][2]
+        files = set(os.path.abspath(i) for i in hdls)
+    finally:
+        os.chdir(cwd)
+    graph = getLibraryGraph()
+    todo = [node["dir"]] + node["deps"]
+    seen = set()
+    while ( todo ):
+        libDir = todo.pop()
+        if ( libDir not in seen ):
+            seen.add(libDir)
+            files.add(os.path.join(libDir, "hdlmake.cfg"))
+            todo.extend(graph.get(libDir, ()))
+    return files
+
+# Map each file watch mode should watch to the set of targets ("validate" or a testbench directory) it affects
+def watchTargets(testBenches):
+    appFiles = dependencyFiles(".")
+    fileMap = dict((i, set(["validate"])) for i in appFiles)
+    for tb in testBenches:
+        files = dependencyFiles(tb) | appFiles
+        files.update(os.path.abspath(i) for i in glob.glob(tb + "/expected.sim") + glob.glob(tb + "/expected/*.sim") + treeFiles(tb + "/stimulus"))
+        for i in files:
+            fileMap.setdefault(i, set()).add(tb)
+    return fileMap
+
+# Get the (mtime, size, inode) of each of the specified files, or None for those which are missing
+def fileStamps(files):
+    stamps = dict()
+    for i in files:
+        try:
+            st = os.stat(i)
+            stamps[i] = (st.st_mtime, st.st_size, st.st_ino)
+        except OSError:
+            stamps[i] = None
+    return stamps
 
-# Clean the directory
+# Get an inotify descriptor watching the specified directories for files being written, created, moved or deleted, or
+# None if inotify isn't available, in which case watch mode polls
+def inotifyWatch(dirs):
+    if ( not sys.platform.startswith("linux") ):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init()
+    except (OSError, AttributeError):
+        return None
+    if ( fd < 0 ):
+        return None
+    watches = 0
+    for i in dirs:
+        path = i.encode(sys.getfilesystemencoding() or "utf-8") if isinstance(i, unicode) else i
+        if ( libc.inotify_add_watch(fd, path, 0x3CC) >= 0 ):  # IN_ATTRIB|IN_CLOSE_WRITE|IN_MOVED_*|IN_CREATE|IN_DELETE
+            watches += 1
+    if ( watches < len(dirs) ):
+        os.close(fd)
+        return None  # probably out of watches
+    return fd
+
+# Wait for up to "timeout" seconds for an inotify event, or just sleep if there's no inotify descriptor
+def waitForEvent(fd, timeout):
+    if ( fd == None ):
+        time.sleep(timeout)
+    elif ( select.select([fd], [], [], timeout)[0] ):
+        os.read(fd, 65536)
+
+# Wait until some of the specified files change, then until the changes have settled (a save often writes several
+# files, or one file several times), returning the files which changed
+def waitForChanges(files):
+    stamps = fileStamps(files)
+    fd = inotifyWatch(set(os.path.dirname(i) for i in files))
+    try:
+        latest = stamps
+        while ( latest == stamps ):
+            waitForEvent(fd, 60 if fd != None else watchPoll)
+            latest = fileStamps(files)
+        while ( True ):
+            waitForEvent(fd, watchSettle)
+            settled = fileStamps(files)
+            if ( settled == latest ):
+                break
+            latest = settled
+    finally:
+        if ( fd != None ):
+            os.close(fd)
+    return set(i for i in files if latest[i] != stamps[i])
+
+# Build once, then keep the parsed configs and the resolved dependency graph in memory, watching the HDLs, configs &
+# expected results they refer to. Whenever some change, rerun just the validation & testbenches they affect
+def watchBuild():
+    if ( os.path.basename(os.getcwd()).startswith("tb_") ):
+        raise HDLException("Watch mode runs from the app directory, not a testbench directory")
+    appDir = os.getcwd()
+    testBenches = sorted(glob.glob("tb_*"))
+    targets = None
+    fileMap = dict()
+    while ( True ):
+        try:
+            if ( targets == None ):
+                topBuild()
+            else:
+                if ( argList.v and "validate" in targets ):
+                    print "[Validating HDLs]"
+                    doValidate(argList.v[0])
+                affected = [i for i in testBenches if i in targets]
+                if ( affected ):
+                    print "[Running tests: " + " ".join(affected) + "]"
+                    runTestbenches(affected)
+            print "[Finished]"
+        except HDLException, ex:
+            print "ERROR: " + str(ex)
+        except (yaml.YAMLError, IOError, OSError), ex:
+            print "ERROR: " + str(ex)
+        finally:
+            os.chdir(appDir)  # a failed build may have left us elsewhere
+        try:
+            fileMap = watchTargets(testBenches)
+        except (HDLException, yaml.YAMLError, IOError, OSError), ex:
+            print "ERROR: " + str(ex)
+            fileMap.update((i, set(["validate"] + testBenches)) for i in cfgCache.keys())
+        sys.stdout.write("[Watching {0} files for changes; Ctrl-C to stop]\n".format(len(fileMap)))
+        sys.stdout.flush()
+        changed = waitForChanges(sorted(fileMap.keys()))
+        for i in sorted(changed):
+            print "Changed: " + i
+        forgetConfigs([i for i in changed if i in cfgCache])
+        targets = set()
+        for i in changed:
+            targets |= fileMap[i]
+
+# Get the list of (template, board) pairs to build with --matrix, given as <template>:<board> on the command line or
+# in the "matrix" list in hdlmake.cfg
+def getMatrix():
+    entries = argList.matrix
+    if ( not entries ):
+        entries = readHdlMake(None).get("matrix") or []
+        if ( not entries ):
+            raise HDLException("No <template>:<board> builds given to --matrix, and hdlmake.cfg has no matrix list")
+    matrix = []
+    for i in entries:
+        (template, sep, board) = i.rpartition(":")
+        if ( not template or not board ):
+            raise HDLException("Build matrix entries should be <template>:<board>, not " + i)
+        if ( (template, board) not in matrix ):
+            matrix.append((template, board))
+    return matrix
+
+# Get the directory in which to build the specified matrix entry
+def matrixDir(template, board):
+    return "build/" + os.path.basename(os.path.normpath(template)) + "-" + board
+
+# Build the app in a matrix entry's work directory. Runs in a worker process; called by runMatrix()
+def matrixWorker(build):
+    (appDir, template, board) = build
+    start = time.time()
+    return (template, board) + runCaptured(appDir, appBuild, template, board, matrixDir(template, board)) + (time.time() - start,)
+
+# Build the current directory's app for each (template, board) pair, each in its own work directory under build/; with
+# -j N they build N at a time in worker processes. Finish with a table of the results
+@traced("build")
+def runMatrix(matrix):
+    dirs = [matrixDir(template, board) for (template, board) in matrix]
+    for i in set(dirs):
+        if ( dirs.count(i) > 1 ):
+            raise HDLException("More than one matrix entry would build in " + i)
+    results = dict()
+    jobs = getJobCount()
+    if ( jobs == 1 or len(matrix) < 2 ):
+        for (template, board) in matrix:
+            print "[Building " + template + ":" + board + "]"
+            start = time.time()
+            try:
+                appBuild(template, board, matrixDir(template, board))
+                error = None
+            except HDLException, ex:
+                error = str(ex)
+                print "ERROR: " + error
+            results[(template, board)] = (error, time.time() - start)
+    else:
+        # Resolve everything up-front so the workers don't race to fetch libraries, run generation rules or copy netlists
+        appTree = readHdlMake(None)
+        for (template, board) in matrix:
+            getDependencies(appTree, None, {"board": board})
+            templateTree = readHdlMake(template, False)
+            if ( templateTree ):
+                getDependencies(templateTree, template, {"board": board})
+        appDir = os.getcwd()
+        builds = [(appDir, template, board) for (template, board) in matrix]
+        for (template, board, error, log, events, elapsed) in poolResults(matrixWorker, builds, jobs):
+            traceEvents.extend(events)
+            print "[Built " + template + ":" + board + "]"
+            sys.stdout.write(log)
+            if ( error ):
+                print "ERROR: " + error
+            sys.stdout.flush()
+            results[(template, board)] = (error, elapsed)
+
+    print "[Build matrix summary]"
+    failCount = 0
+    for (template, board) in matrix:
+        (error, elapsed) = results[(template, board)]
+        workDir = matrixDir(template, board)
+        if ( error ):
+            failCount += 1
+            print "  FAIL {0:<36} {1:>8.1f}s  {2}".format(template + ":" + board, elapsed, error.splitlines()[-1])
+        else:
+            outputs = [workDir + "/" + i for i in ("top_level.bit", "top_level.jed", "top_level.sof") if os.path.exists(workDir + "/" + i)]
+            print "  PASS {0:<36} {1:>8.1f}s  {2}".format(template + ":" + board, elapsed, " ".join(outputs))
+    if ( failCount ):
+        raise HDLException("{0} of {1} matrix builds failed".format(failCount, len(matrix)))
+
+# Compile a list of glob patterns into a single regex matching any of them
+def compilePatterns(patterns):
+    key = tuple(patterns)
+    if ( key not in patternCache ):
+        regex = "|".join(re.escape(i).replace("\\*", ".*").replace("\\?", ".") for i in patterns)
+        patternCache[key] = re.compile("^(?:" + regex + ")$", re.IGNORECASE if ( os.name == 'nt' ) else 0)
+    return patternCache[key]
+
+# List the specified directory once, collecting the files and directories matching the clean manifest, then do the
+# same in each of its testbench directories. A directory's hdlmake.cfg may replace the manifest with its own "clean"
+# list of patterns, which then also applies to its testbenches. Called by doClean()
+def findCleanable(directory, patterns, files, dirs):
+    tree = readHdlMake(directory, False)
+    if ( isinstance(tree, dict) and "clean" in tree ):
+        patterns = tree["clean"] or []
+    matcher = compilePatterns(patterns)
+    for name in sorted(os.listdir(directory)):
+        path = name if ( directory == "." ) else directory + "/" + name
+        isDir = os.path.isdir(path) and not os.path.islink(path)
+        if ( matcher.match(name) ):
+            if ( isDir ):
+                dirs.append(path)
+            else:
+                files.append(path)
+        elif ( isDir and name.startswith("tb_") ):
+            findCleanable(path, patterns, files, dirs)
+
+# Clean the directory and its testbench directories. With --dry-run, just list what would be deleted
 def doClean():
-    for i in ["*.bak", "*.bgn", "*.bin", "*.bit", "*.bld", "*.cfi", "*.cmd", "*.cmd_log", "*.csv", "*.csvf",
-              "*.done", "*.dpf", "*.drc", "*.edif", "*.err", "*.gise", "*.gyd", "*.html", "*.ise", "*.jdi", "*.jed",
-              "*.log", "*.lso", "*.map", "*.mcs", "*.mfd", "*.mrp", "*.ncd", "*.ngc", "*.ngd", "*.ngm", "*.ngr",
-              "*.ntrc_log", "*.pad", "*.par", "*.pcf", "*.pin", "*.pnx", "*.pof", "*.prj", "*.prm", "*.ptwx",
-              "*.qpf", "*.qsf", "*.rbf", "*.rpt", "*.sdc", "*.smsg", "*.sof", "*.srf", "*.stx",
-              "*.summary", "*.svf", "*.syr", "*.tspec", "*.twr", "*.twr", "*.twx", "*.txt", "*.unroutes",
-              "*.vm6", "*.xml", "*.xpi", "*.xrpt", "*.xsvf", "*.xwbt"]:
-        wildcardDelete(i)
-    for i in ["results.sim"]:
-        if ( os.path.exists(i) ):
-            os.remove(i)
-    for i in ["xst", "db", "incremental_db", "_ngo", "_xmsgs", "auto_project_xdb", "iseconfig", "xlnx_auto_0_xdb", "top_level_html", "simulation", "synthesis", "results"]:
-        if ( os.path.exists(i) ):
-            shutil.rmtree(i)
-    foreachTestbench(doClean)
+    files = []
+    dirs = []
+    findCleanable(".", cleanPatterns, files, dirs)
+    if ( argList.dry_run ):
+        total = 0
+        for i in sorted(files + dirs):
+            size = treeSize(i) if ( i in dirs ) else os.lstat(i).st_size
+            total += size
+            print "  {0:>12}  {1}{2}".format(size, i, "/" if ( i in dirs ) else "")
+        print "Would delete {0} files and {1} directories, freeing {2} bytes".format(len(files), len(dirs), total)
+        return
+    for i in files:
+        os.remove(i)
+    if ( dirs ):
+        # Deleting big trees (e.g. Quartus db/ on a network filesystem) is mostly waiting, so do several at once
+        pool = ThreadPool(min(len(dirs), max(getJobCount(), 4)))
+        try:
+            pool.map(shutil.rmtree, dirs)
+        finally:
+            pool.close()
+            pool.join()
+    if ( argList.prune ):
+        pruneNetlists()
 
+@traced("build")
 def topBuild():
     dirname = os.path.basename(os.getcwd())
+    traceNote(dir=dirname)
     if ( dirname[:3] == "tb_" ):
         # We're building in a test directory
         print "[Testbench: " + dirname + "]"
         varMap = {"board": "sim"}
+        cwd = os.getcwd()
+        shared = appContext != None and appContext["dir"] == os.path.dirname(cwd)
+        prefetchRepos([None] if shared else [None, ".."], varMap)
+        generateLibraries([None] if shared else [None, ".."], varMap)
         tbTree = readHdlMake(None)
         (tbTop, tbHdls) = getDependencies(tbTree, None, varMap)
         tbTopLevel = os.path.splitext(os.path.basename(tbTop))[0]
-        cwd = os.getcwd()
-        os.chdir("..")
-        if ( argList.v ):
-            doValidate(argList.v[0])
-        appTree = readHdlMake(None)
-        (appTop, appHdls) = getDependencies(appTree, None, varMap)
+        if ( shared ):
+            # Run from the app directory, which has already resolved & validated the app
+            appHdls = appContext["hdls"]
+        else:
+            os.chdir("..")
+            try:
+                if ( argList.v ):
+                    doValidate(argList.v[0])
+                appTree = readHdlMake(None)
+                (appTop, appHdls) = getDependencies(appTree, None, varMap)
+            finally:
+                os.chdir(cwd)
         tbHdls.extend([i if i.startswith(topDir) else "../" + i for i in appHdls])
-        os.chdir(cwd)
-        if ( isBuildNeeded("simulation/TIMESTAMP", tbHdls) ):
+        stopTime = "41280ns"
+        if ( "stopTime" in tbTree ):
+            stopTime = tbTree["stopTime"]
+        runs = getRuns(tbTree, stopTime)
+        simInputs = tbHdls + glob.glob("expected.sim") + glob.glob("expected/*.sim") + treeFiles("stimulus")
+        for i in runs:
+            simInputs.extend(runInputs(i))
+        fingerprint = getFingerprint(simInputs, [
+            ghdlFlags, tbTopLevel, stopTime, json.dumps(tbTree.get("compare"), sort_keys=True),
+            json.dumps(tbTree.get("runs"), sort_keys=True)])
+        waves = argList.w or isEnabled(tbTree, "waves")
+        ghwFiles = [i["dir"] + "/" + tbTopLevel + ".ghw" for i in runs] or ["simulation/" + tbTopLevel + ".ghw"]
+        waveFingerprint = fingerprint + (":subset" if isEnabled(tbTree, "waveSubset") else ":all")
+        if ( isBuildNeeded("simulation/TIMESTAMP", fingerprint) or (waves and any(isBuildNeeded(i, waveFingerprint) for i in ghwFiles)) ):
             print "HDL simulation:"
-            if ( os.path.exists("simulation") ):
-                shutil.rmtree("simulation")
-            mkdir("simulation")
+            traceNote(cache="miss")
+            for i in ["simulation/TIMESTAMP"] + ghwFiles:
+                recordBuild(i, None)  # until it succeeds
+            ghdlAnalyse(tbHdls, tbTopLevel)
             open("simulation/TIMESTAMP", "a").close()
             os.utime("simulation/TIMESTAMP", (0, 0))  # set last-mod time to 1970
-            if ( os.path.exists("stimulus") ):
+            if ( os.path.exists("stimulus") and not runs ):
                 mkdir("results")
-            cmd = "ghdl -i --ieee=synopsys --std=93c --vital-checks --warn-binding --warn-reserved --warn-library --warn-vital-generic --warn-delayed-checks --warn-body --warn-specs --warn-unused --warn-error --workdir=simulation --work=work " + " ".join(tbHdls)
-            #print cmd
-            if ( os.system(cmd) ):
-                raise HDLException("The ghdl first stage build failed")
-            cmd = "ghdl -m --ieee=synopsys --std=93c --vital-checks --warn-binding --warn-reserved --warn-library --warn-vital-generic --warn-delayed-checks --warn-body --warn-specs --warn-unused --warn-error --workdir=simulation --work=work " + tbTopLevel
-            #print cmd
-            if ( os.system(cmd) ):
-                raise HDLException("The ghdl second stage build failed")
+            with tracePhase("elaborate", "sim"):
+                error = runTool("elaborate", ["ghdl", "-e"] + ghdlFlags.split() + [tbTopLevel], None)
+                if ( error ):
+                    raise HDLException("The ghdl elaboration failed: " + error)
             print "Moving " + tbTopLevel + " to simulation directory"
-            shutil.move(tbTopLevel, "simulation")
-            stopTime = "41280ns"
-            if ( "stopTime" in tbTree ):
-                stopTime = tbTree["stopTime"]
-            cmd = "./simulation/" + tbTopLevel + " --stop-time=" + stopTime + " --wave=simulation/" + tbTopLevel + ".ghw"
-            #print cmd
-            if ( os.system(cmd) ):
-                raise HDLException("The ghdl simulation failed")
-            if ( os.path.exists("expected.sim") ):
-                if ( os.path.exists("results.sim") ):
-                    if ( not filecmp.cmp("expected.sim", "results.sim") ):
-                        raise HDLException("The simulation produced unexpected results")
-                else:
-                    raise HDLException("The simulation did not produce results")
-            if ( os.path.exists("expected") ):
-                files = glob.glob("expected/*.sim")
-                for expectedFile in files:
-                    resultFile = expectedFile.replace("expected", "results")
-                    if ( os.path.exists(resultFile) ):
-                        if ( not filecmp.cmp(expectedFile, resultFile) ):
-                            raise HDLException("The simulation produced unexpected results: %s and %s differ" % (expectedFile, resultFile))
-                    else:
-                        raise HDLException("The simulation did not produce results: %s missing" % resultFile)
+            shutil.move(tbTopLevel, "simulation/" + tbTopLevel)
+            if ( runs ):
+                runSweep(tbTree, tbTopLevel, runs, waves)
+            else:
+                runSimulation(tbTree, tbTopLevel, stopTime, waves)
+                try:
+                    with tracePhase("compare", "sim"):
+                        compareResults(tbTree)
+                except HDLException, ex:
+                    if ( not waves ):
+                        print "Rerunning the simulation with waves, to help find the problem"
+                        try:
+                            runSimulation(tbTree, tbTopLevel, stopTime, True)
+                            print "Waves are in " + ghwFiles[0]
+                        except HDLException, rerunEx:
+                            print "Warning: " + str(rerunEx)
+                    raise ex
+            if ( waves ):
+                for i in ghwFiles:
+                    recordBuild(i, waveFingerprint)
             os.utime("simulation/TIMESTAMP", None)  # set last-mod time to now
+            recordBuild("simulation/TIMESTAMP", fingerprint)
         else:
             print "HDL simulation: Nothing to do"
+            traceNote(cache="hit")
 
         if ( argList.w and "signals" in tbTree ):
             print "[Preparing GTKWave]"
@@ -617,20 +2842,38 @@ def topBuild():
                             g.write("{0} {1}\n".format(tag, sigMap[tag]))
                     g.close()
             f.close()
-            os.system("gtkwave -T simulation/startup.tcl simulation/" + tbTopLevel + ".ghw")
+            os.system("gtkwave -T simulation/startup.tcl " + ghwFiles[0])
     else:
+        template = argList.t[0] if argList.t else None
+        board = argList.b[0] if argList.b else None
+        matrix = None
+        if ( argList.matrix != None ):
+            if ( template != None or board != None or argList.i ):
+                raise HDLException("A build matrix cannot be combined with -t, -b or -i")
+            matrix = getMatrix()
+
+        # Fetch any missing libraries & generate any missing files up-front
+        prefetchRepos([None] + sorted(glob.glob("tb_*")), {"board": "sim"})
+        generateLibraries([None] + sorted(glob.glob("tb_*")), {"board": "sim"})
+        if ( template != None and board != None ):
+            prefetchRepos([None, template], {"board": board})
+            generateLibraries([None, template], {"board": board})
+        for (t, b) in matrix or []:
+            prefetchRepos([None, t], {"board": b})
+            generateLibraries([None, t], {"board": b})
+
         # Run tests...
         if ( argList.v ):
             print "[Validating HDLs]"
             doValidate(argList.v[0])
         print "[Running tests]"
-        foreachTestbench(topBuild)
+        runTestbenches()
         print "[Finished testing]"
-        template = argList.t[0] if argList.t else None
-        board = argList.b[0] if argList.b else None
 
         # Load the hdlmake.cfg file from the current directory
-        if ( template == None ):
+        if ( matrix != None ):
+            runMatrix(matrix)
+        elif ( template == None ):
             if ( board != None ):
                 raise HDLException("I have a board but no template")
             # else
@@ -758,19 +3001,34 @@ if __name__ == "__main__":
     parser.add_argument('-x', action="store", nargs=1, metavar="<subdir>", help="make the named subdir and launch coregen")
     parser.add_argument('-z', action="store", nargs="*", metavar="<subdir>", help="clean the specified coregen/megawiz directories and exit")
     parser.add_argument('-v', action="store", nargs=1, metavar="<x|a>", help="validate with either Xilinx or Altera")
-    parser.add_argument('-w', action="store_true", default=False, help="display the simulation waves")
+    parser.add_argument('-w', action="store_true", default=False, help="dump & display the simulation waves")
     parser.add_argument('-i', action="store", nargs=1, metavar="<subdir>", help="copy files locally in preparation for an IDE build")
     parser.add_argument('-g', action="store", nargs=1, metavar="<user/repo>", help="fetch the specified GitHub repo")
     parser.add_argument('-p', action="store", nargs="*", metavar="<rule>", help="generate the specified programming file(s)")
     parser.add_argument('-s', action="store", nargs=1, metavar="<rule>", help="set the supplied top-level generics")
     parser.add_argument('-f', action="store_true", default=False, help="avoid confirmation when zeroing: DANGEROUS")
+    parser.add_argument('--offline', action="store_true", default=False, help="never fetch libraries; fail if one is not in the archive cache")
+    parser.add_argument('--artifacts', action="store", nargs=1, metavar="<dir|url>", help="share synthesis outputs through the specified artifact cache")
+    parser.add_argument('--dry-run', action="store_true", default=False, help="with -c, list what would be deleted and how big it is")
+    parser.add_argument('--prune', action="store_true", default=False, help="with -c, also remove the netlists no longer used by any build from the shared netlist store")
+    parser.add_argument('--watch', action="store_true", default=False, help="build, then rerun the affected validation & tests whenever an HDL or config changes")
+    parser.add_argument('--matrix', action="store", nargs="*", metavar="<template:board>", help="build for each template & board (default: the hdlmake.cfg matrix list) in build/")
+    parser.add_argument('--timeout', action="store", nargs=1, type=int, metavar="<secs>", help="stop any tool which runs for longer than <secs> (override per tool with \"timeouts\" in hdlmake.cfg)")
+    parser.add_argument('--trace', action="store", nargs=1, metavar="<file>", help="write a Chrome trace of the build phases to <file> and print a timing summary")
+    parser.add_argument('-j', action="store", nargs=1, type=int, metavar="<jobs>", help="run up to <jobs> testbenches or matrix builds in parallel")
+    parser.add_argument('--slots', action="store", nargs=1, type=int, metavar="<n>", help="share <n> job slots (default: one per CPU) between the tools run by every hdlmake on this machine")
+    parser.add_argument('--fail-fast', action="store_true", default=False, help="run the testbenches which failed last time first, and stop at the first failure")
     argList = parser.parse_args()
 
-    brFileName = topDir + "/.branch";
-    if (os.path.exists(brFileName) ):
-        brFile = open(brFileName)
-        branch = brFile.read().strip()
-        brFile.close()
+    offline = offline or argList.offline
+    if ( argList.artifacts ):
+        artifactCache = argList.artifacts[0]
+    if ( argList.timeout ):
+        toolTimeout = argList.timeout[0]
+    if ( argList.slots ):
+        slotBudget = argList.slots[0]
+    if ( argList.trace ):
+        traceFile = os.path.abspath(argList.trace[0])
     try:
         if ( argList.c ):
             doClean()
@@ -782,11 +3040,20 @@ if __name__ == "__main__":
             getRepo(user, repo)
         elif ( argList.x ):
             xilinxBlock(argList.x[0])
+        elif ( argList.watch ):
+            try:
+                watchBuild()
+            except KeyboardInterrupt:
+                print "\nStopped watching"
         elif ( argList.a ):
             alteraBlock(argList.a[0])
         else:
             topBuild()
+        if ( traceFile ):
+            writeTrace()
         print "Success!"
     except HDLException, ex:
+        if ( traceFile ):
+            writeTrace()
         print "ERROR: " + str(ex)
         exit(3)